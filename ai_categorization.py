@@ -1,14 +1,22 @@
 
 from sqlalchemy import create_engine
 from datamodels import ConfigFile
+from category_cache import CategoryCache
+from database_manager import DatabaseManager
+from local_categorizer import LocalCategorizer
+from job_runner import report_progress
 from loguru import logger
 from langchain_openai import ChatOpenAI
 from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.exceptions import OutputParserException
 from langchain.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
 from dotenv import load_dotenv
 import pandas as pd
+import tiktoken
+import asyncio
 import json
+import time
 import os
 
 load_dotenv(override=True)
@@ -21,30 +29,129 @@ class song_features(BaseModel):
     decade: str = Field(description="Decade of the song. Must be ONLY ONE OF THESE: '90s or before', '00s' or '10s or later'")
 
 
+# categorizers tried before the LLM, which only gets the songs they are not confident about. A categorizer is built with the
+# category names and the minimum confidence, learns from categorized rows with fit and returns labels and confidences with predict
+CATEGORIZERS = {
+    'local': LocalCategorizer,
+}
+
 class AIChatCategorization():
-    def __init__(self):
-        db_path = os.getenv('db_url')
+    def __init__(self, database_manager:DatabaseManager|None=None):
+        '''the categories are cached in the database of database_manager, or of db_url when none is given
+        '''
         config_file_path = os.getenv('config_file_path')
 
-        self.engine = create_engine(db_path)
         with open(config_file_path) as f:
-            self.config = json.load(f)
+            config = json.load(f)
 
-        self.config = ConfigFile(**self.config)
+        self.database_manager = database_manager or DatabaseManager(create_engine(os.getenv('db_url')))
+        self.config = None
+        self.apply_config(ConfigFile(**config))
 
+    def apply_config(self, config:ConfigFile)->None:
+        '''take the AI settings of config, the model client and its tokenizer are only rebuilt when the model changed
+        '''
+        model_changed = self.config is None or self.config.AI_configurations.model != config.AI_configurations.model
+        self.config = config
         self.prompt_templates_path = self.config.AI_configurations.prompt_templates_filepaths
         self.categories = self.config.AI_configurations.categories
+        if not model_changed:
+            return
 
         self.llm = ChatOpenAI(model=self.config.AI_configurations.model)
+        try:
+            self.encoding = tiktoken.encoding_for_model(self.config.AI_configurations.model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding('o200k_base')
+        except Exception as error:
+            # the encodings are downloaded on first use, without them the tokens are estimated from the text length
+            logger.warning(f'Could not load the tiktoken encoding ({error!r}), estimating token counts')
+            self.encoding = None
+
+    def categorized_in_other_playlists(self, track_ids:list[str], categories_names:list[str])->dict:
+        '''categories the tracks already have in the rows of other playlists, by track id, whether they came from the LLM, the local
+        categorizer or a manual edit
+        '''
+        if not track_ids or not set(categories_names) <= set(self.database_manager.table_columns('playlist')):
+            return {}
+        categorized = self.database_manager.read_tracks(track_ids, columns=['id'] + categories_names, not_null=categories_names).drop_duplicates(subset=['id'])
+        logger.info(f'{len(categorized)}/{len(track_ids)} uncached songs already categorized in other playlists')
+        return categorized.set_index('id')[categories_names].to_dict(orient='index')
+
+    def categorize_locally(self, songs:pd.DataFrame, categories_names:list[str], category_cache:CategoryCache)->dict:
+        '''categories of the songs the configured categorizer is confident about, by track id. It is trained on the categories the
+        LLM gave in the category cache of the current version, and not used until there are local_min_training_rows of them. The
+        categories in the playlist table are left out, as they include the predictions of the categorizer itself
+        '''
+        settings = self.config.AI_configurations
+        if settings.categorizer is None or songs.empty:
+            return {}
+        labels = pd.DataFrame.from_dict(category_cache.read_all(), orient='index').reindex(columns=categories_names).dropna()
+        training_df = labels
+        if len(labels) >= settings.local_min_training_rows:
+            features = self.database_manager.read_tracks(labels.index.tolist(), columns=['id', 'artists', 'genres', 'release_date'])
+            training_df = features.drop_duplicates(subset=['id']).join(labels, on='id', how='inner')
+        if len(training_df) < settings.local_min_training_rows:
+            logger.info(f'Only {len(training_df)} categorized songs to train the {settings.categorizer} categorizer, skipping it')
+            return {}
+        categorizer = CATEGORIZERS[settings.categorizer](categories_names, settings.local_min_confidence).fit(training_df)
+        start = time.perf_counter()
+        predictions = categorizer.predict(songs)
+        confident = categorizer.confident(predictions)
+        logger.info(f'{confident.sum()}/{len(songs)} songs categorized by the {settings.categorizer} categorizer in {time.perf_counter() - start:.3f}s')
+        return predictions.loc[confident, categories_names].set_axis(songs.loc[confident, 'id']).to_dict(orient='index')
+
+    def count_tokens(self, text:str)->int:
+        if self.encoding is None:
+            return len(text)//4 + 1
+        return len(self.encoding.encode(text))
+
+    def pack_chunks(self, songs:list[dict])->list[list[dict]]:
+        '''group the songs in chunks that fit the token budgets of a request, both for the songs sent and for the answer expected
+        back, which repeats the id, name and artists of every song. Chunks never get more than chunk_size songs
+        '''
+        settings = self.config.AI_configurations
+        chunks = []
+        chunk, input_tokens, output_tokens = [], 0, 0
+        for song in songs:
+            song_input_tokens = self.count_tokens(json.dumps(song, ensure_ascii=False))
+            song_output_tokens = self.count_tokens(' '.join(str(song.get(field, '')) for field in ['id', 'name', 'artists'])) + settings.output_tokens_per_song
+            fits = input_tokens + song_input_tokens <= settings.max_input_tokens_per_request and output_tokens + song_output_tokens <= settings.max_output_tokens_per_request
+            if chunk and (not fits or len(chunk) == settings.chunk_size):
+                chunks.append(chunk)
+                chunk, input_tokens, output_tokens = [], 0, 0
+            chunk.append(song)
+            input_tokens += song_input_tokens
+            output_tokens += song_output_tokens
+        if chunk:
+            chunks.append(chunk)
+        return chunks
         
     def get_categorization(self, playlist_df:pd.DataFrame, features_columns: list[str], categories_names:list[str]=['genre', 'country', 'decade'])->pd.DataFrame:
+        return asyncio.run(self.aget_categorization(playlist_df, features_columns, categories_names))
+
+    async def aget_categorization(self, playlist_df:pd.DataFrame, features_columns: list[str], categories_names:list[str]=['genre', 'country', 'decade'])->pd.DataFrame:
+        '''categorize the songs that have no category yet. Tracks already in the category cache for the current model, prompt and
+        categories are not sent to the LLM, neither are those categorized in other playlists nor those the configured categorizer is
+        confident about. The others go in
+        chunks packed to the token budgets of a request, concurrently (at most max_concurrent_requests at a time). Songs missing from
+        a truncated answer are asked again in smaller chunks. Failed LLM calls are retried with jittered exponential backoff, a chunk
+        that still fails is logged and left uncategorized
+        '''
         logger.info("Starting the categorization process")
-        playlist_df[categories_names] = None
-        
+        for category in categories_names:
+            if category not in playlist_df.columns:
+                playlist_df[category] = None
+        pending = playlist_df[categories_names].isnull().all(axis=1)
+
         categorization_prompt_file = self.prompt_templates_path["categorization"]
         with open(categorization_prompt_file) as f:
             categorization_prompt = f.read()
         logger.info("Prompt loaded")
+        category_cache = CategoryCache(self.database_manager, self.config.AI_configurations.model, categorization_prompt, self.categories)
+        pending_track_ids = playlist_df.loc[pending, 'id'].dropna().unique().tolist()
+        categories = category_cache.get(pending_track_ids)
+        categories.update(self.categorized_in_other_playlists([track_id for track_id in pending_track_ids if track_id not in categories], categories_names))
         parser = JsonOutputParser(pydantic_object=song_features)
         prompt = PromptTemplate(
             template=categorization_prompt,
@@ -52,37 +159,68 @@ class AIChatCategorization():
             partial_variables={"format_instructions": parser.get_format_instructions()}
         )
         logger.info("Prompt created")
-        chain = prompt | self.llm | parser
+        llm = self.llm.with_retry(stop_after_attempt=self.config.AI_configurations.max_retries, wait_exponential_jitter=True)
+        chain = prompt | llm | parser
         logger.info("Chain created")
-        chunk_size = 30
-        data_categories = pd.DataFrame()
-        if len(playlist_df) < chunk_size:
-            logger.info("performing categorization in one go")
-            features: dict = playlist_df[playlist_df[categories_names].isnull().all(axis=1)][features_columns].to_dict(orient='records')
-            logger.info("Categorizing songs with OpenAI LLM")
-            response = chain.invoke({"features": features, "categories": self.categories})
-            logger.info(f"Categorization don for iteration {i}, response length: {len(response)}")
-            data_categories = pd.concat([data_categories,pd.DataFrame(response)],ignore_index=True)
-            logger.info(f"{len(playlist_df)} songs categorized. current response length: {len(data_categories)}")
-            for id in data_categories['id']:
-                playlist_df.loc[playlist_df['id'] == id, categories_names] = data_categories.loc[data_categories['id'] == id, categories_names].values
-            return playlist_df
-        
-        logger.info("entering categorization loop")
-        for i in range(0, len(playlist_df), chunk_size):
-            chunk = playlist_df[i:i+chunk_size]
-            features: dict = chunk[chunk[categories_names].isnull().all(axis=1)][features_columns].to_dict(orient='records')
-            logger.info("Categorizing songs with OpenAI LLM")
-            response = chain.invoke({"features": features, "categories": self.categories})
-            logger.info(f"Categorization don for iteration {i}, response length: {len(response)}")
-            data_categories = pd.concat([data_categories,pd.DataFrame(response)],ignore_index=True)
-            logger.info(f"{i+chunk_size}/{len(playlist_df)} songs categorized. current response length: {len(data_categories)}")
-        
-        for id in data_categories['id']:
-                playlist_df.loc[playlist_df['id'] == id, categories_names] = data_categories.loc[data_categories['id'] == id, categories_names].values
-        return playlist_df
 
+        uncached = pending & ~playlist_df['id'].isin(categories)
+        categories.update(self.categorize_locally(playlist_df[uncached].drop_duplicates(subset=['id']), categories_names, category_cache))
+        uncached = pending & ~playlist_df['id'].isin(categories)
+        songs = playlist_df[uncached].drop_duplicates(subset=['id'])[features_columns].to_dict(orient='records')
+        chunks = self.pack_chunks(songs)
+        logger.info(f"Categorizing {len(songs)} songs with OpenAI LLM in {len(chunks)} chunks")
+        # one ainvoke per chunk rather than abatch, whose retry wrapper can hand a retried chunk the response of another one
+        semaphore = asyncio.Semaphore(self.config.AI_configurations.max_concurrent_requests)
+        requests = 0
+        async def categorize_chunk(chunk:list[dict])->list[dict]:
+            nonlocal requests
+            try:
+                async with semaphore:
+                    requests += 1
+                    response = await chain.ainvoke({"features": chunk, "categories": self.categories})
+            except OutputParserException as error:
+                logger.warning(f"Unreadable answer for a chunk of {len(chunk)} songs: {error!r}")
+                response = []
+            except Exception as error:
+                logger.error(f"Categorization failed for a chunk of {len(chunk)} songs: {error!r}")
+                return []
+            # a single song may come back as an object instead of a list
+            response = [response] if isinstance(response, dict) else [song for song in response if isinstance(song, dict)]
+            answered = {song.get('id') for song in response if all(song.get(category) is not None for category in categories_names)}
+            missing = [song for song in chunk if song['id'] not in answered]
+            if not missing or len(chunk) == 1:
+                return response
+            # most likely an answer cut at the output limit, the missing songs are asked again in smaller chunks until they fit
+            logger.warning(f"{len(missing)} of {len(chunk)} songs missing from the answer, asking for them again")
+            if len(missing) == len(chunk):
+                halves = await asyncio.gather(categorize_chunk(missing[:len(missing)//2]), categorize_chunk(missing[len(missing)//2:]))
+                retried = halves[0] + halves[1]
+            else:
+                retried = await categorize_chunk(missing)
+            return [song for song in response if song.get('id') in answered] + retried
 
+        categorized_chunks = 0
+        async def categorize_and_report(chunk:list[dict])->list[dict]:
+            nonlocal categorized_chunks
+            response = await categorize_chunk(chunk)
+            categorized_chunks += 1
+            report_progress('chunks_categorized', categorized_chunks, len(chunks))
+            return response
 
-        
-        
+        start = time.perf_counter()
+        report_progress('chunks_categorized', 0, len(chunks))
+        responses = await asyncio.gather(*[categorize_and_report(chunk) for chunk in chunks])
+        elapsed = time.perf_counter() - start
+        data_categories = pd.DataFrame([song for response in responses for song in response]).reindex(columns=['id'] + categories_names)
+        logger.info(f"{len(data_categories)}/{len(songs)} songs categorized in {requests} requests and {elapsed:.1f}s")
+
+        # only the songs that were asked for, and only complete answers are cached
+        data_categories = data_categories[data_categories['id'].isin([song['id'] for song in songs])].drop_duplicates(subset=['id'], keep='last')
+        new_categories = data_categories.set_index('id')[categories_names].to_dict(orient='index')
+        category_cache.put({track_id: track_categories for track_id, track_categories in new_categories.items() if not pd.isna(list(track_categories.values())).any()})
+        categories.update(new_categories)
+
+        categories = pd.DataFrame.from_dict(categories, orient='index').reindex(columns=categories_names)
+        for category in categories_names:
+            playlist_df.loc[pending, category] = playlist_df.loc[pending, 'id'].map(categories[category])
+        return playlist_df
@@ -0,0 +1,55 @@
+'''check that the fitness the genetic algorithm keeps for every individual matches the reference pandas_fitness_function, generation
+after generation, on synthetic playlists where one genre and one decade are rare, so the repair operators run on most crossovers.
+Exits with status 1 on the first mismatch.
+
+usage: python -m benchmarks.check_fitness_consistency [--size 1500] [--seeds 5] [--generations 15]
+'''
+from benchmarks.synthetic_playlist import build_synthetic_playlist
+from loguru import logger
+import numpy as np
+import argparse
+import random
+import sys
+import os
+
+os.environ.setdefault('config_file_path', 'config/config.json')
+
+from playlist_optmizer import PlaylistOptimizer
+
+def check_fitness_consistency(size:int, seeds:int, generations:int)->int:
+    '''number of individuals whose stored fitness differs from the reference one
+    '''
+    mismatches = 0
+    optimizer = PlaylistOptimizer()
+    parameters = optimizer.default_optimization_parameters
+    for seed in range(seeds):
+        playlist = build_synthetic_playlist(size, seed)
+        rng = np.random.default_rng(seed)
+        playlist['genre'] = rng.choice(['pop', 'rock', 'metal'], size, p=[0.5, 0.49, 0.01])
+        playlist['decade'] = rng.choice(['90s', '00s', '10s'], size, p=[0.5, 0.49, 0.01])
+        optimizer.load_playlist(playlist)
+        random.seed(seed)
+        population = optimizer.toolbox.population(n=parameters.population_size)
+        optimizer.assign_fitnesses(population)
+        for generation in range(generations):
+            population = optimizer.evolve_population(population, 1, parameters.crossover_probability, parameters.mutation_probability)
+            for individual in population:
+                expected = optimizer.pandas_fitness_function(individual)[0]
+                if not np.isclose(individual.fitness.values[0], expected, rtol=1e-6, atol=1e-9):
+                    mismatches += 1
+                    logger.error(f'seed {seed}, generation {generation}: stored fitness {individual.fitness.values[0]}, expected {expected}')
+        logger.info(f'seed {seed}: {generations} generations checked')
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=1500)
+    parser.add_argument('--seeds', type=int, default=5)
+    parser.add_argument('--generations', type=int, default=15)
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', filter=lambda record: record['name'].startswith('__main__'))
+    mismatches = check_fitness_consistency(args.size, args.seeds, args.generations)
+    logger.info(f'{mismatches} mismatches')
+    sys.exit(1 if mismatches else 0)
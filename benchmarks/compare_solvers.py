@@ -0,0 +1,51 @@
+'''compare the solution quality and the wall time of every setlist solver on synthetic playlists.
+
+usage: python -m benchmarks.compare_solvers [--sizes 1000 3000] [--seeds 3]
+'''
+from benchmarks.synthetic_playlist import build_synthetic_playlist
+from loguru import logger
+import argparse
+import random
+import json
+import time
+import sys
+import os
+
+os.environ.setdefault('config_file_path', 'config/config.json')
+
+from playlist_optmizer import PlaylistOptimizer
+
+SOLVERS = ['ga', 'annealing']
+
+def compare_solvers(sizes:list[int], seeds:int)->list[dict]:
+    results = []
+    optimizer = PlaylistOptimizer()
+    optimizer.config.general.island_model.islands = 1
+    for size in sizes:
+        playlist = build_synthetic_playlist(size)
+        optimizer.load_playlist(playlist)
+        for solver in SOLVERS:
+            for seed in range(seeds):
+                random.seed(seed)
+                optimizer.default_optimization_parameters.solver_seed = seed
+                start = time.perf_counter()
+                setlist = optimizer.run_solver(solver)
+                elapsed = time.perf_counter() - start
+                results.append({
+                    'solver': solver,
+                    'playlist_size': size,
+                    'seed': seed,
+                    'seconds': elapsed,
+                    'fitness': optimizer.fitness_function(setlist)[0],
+                })
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 3000])
+    parser.add_argument('--seeds', type=int, default=3)
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+    json.dump(compare_solvers(args.sizes, args.seeds), sys.stdout, indent=4)
@@ -0,0 +1,123 @@
+'''benchmark suite for the optimizer and clusterer stages, on synthetic playlists. Runs offline, without Spotify or OpenAI credentials,
+and writes a machine-readable JSON report so the numbers can be tracked between releases.
+
+usage: python -m benchmarks.run_benchmarks [--sizes 100 1000 10000 100000] [--output benchmark.json]
+'''
+from benchmarks.synthetic_playlist import build_synthetic_playlist
+from loguru import logger
+import pandas as pd
+import numpy as np
+import tracemalloc
+import platform
+import argparse
+import random
+import json
+import time
+import sys
+import os
+
+os.environ.setdefault('config_file_path', 'config/config.json')
+
+from playlist_optmizer import PlaylistOptimizer
+from playlist_clusterer import PlaylistClusterer
+
+def measure(stage:str, playlist_size:int, function, calls:int=1)->dict:
+    '''time calls executions of function, then run it once more under tracemalloc to get its peak memory.
+    Both are measured separately because tracing allocations slows the code down.
+    '''
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        'stage': stage,
+        'playlist_size': playlist_size,
+        'calls': calls,
+        'seconds': elapsed,
+        'calls_per_second': calls/elapsed if elapsed > 0 else None,
+        'peak_memory_mb': peak/1024**2,
+    }
+    logger.info(f'{stage} ({playlist_size} tracks): {result["calls_per_second"]:.1f} calls/s, {result["peak_memory_mb"]:.2f} MB peak')
+    return result
+
+def benchmark_playlist(playlist_size:int, evaluations:int, generations:int, seed:int)->list[dict]:
+    random.seed(seed)
+    playlist = build_synthetic_playlist(playlist_size, seed)
+    optimizer = PlaylistOptimizer()
+    optimizer.config.general.island_model.islands = 1
+    parameters = optimizer.default_optimization_parameters
+    parameters.generations = generations
+    parameters.stagnation_generations = None
+    parameters.time_budget_seconds = None
+    setlist_size = min(optimizer.setlist_size, playlist_size)
+    optimizer.setlist_size = setlist_size
+
+    results = [measure('load_playlist', playlist_size, lambda: optimizer.load_playlist(playlist))]
+
+    # random setlists are almost never repeated, the cache is disabled anyway to time the fitness engine itself
+    optimizer.fitness_cache.max_size = 0
+    setlists = [random.sample(range(playlist_size), setlist_size) for _ in range(evaluations)]
+    setlist_iterator = iter(setlists*2)
+    results.append(measure('fitness_function', playlist_size, lambda: optimizer.fitness_function(next(setlist_iterator)), evaluations))
+
+    population_size = parameters.population_size
+    populations = [setlists[i:i + population_size] for i in range(0, evaluations - population_size + 1, population_size)]
+    population_iterator = iter(populations*2)
+    population_result = measure('evaluate_population', playlist_size, lambda: optimizer.evaluate_population(next(population_iterator)), len(populations))
+    population_result['evaluations_per_second'] = population_result['calls_per_second']*population_size
+    results.append(population_result)
+    optimizer.fitness_cache.max_size = optimizer.config.general.fitness_cache_size
+
+    # setlists with a third of their songs repeated
+    duplicated_setlists = [setlist[:setlist_size - setlist_size//3] + setlist[:setlist_size//3] for setlist in setlists[:200]]
+    duplicated_iterator = iter([list(setlist) for setlist in duplicated_setlists*2])
+    results.append(measure('remove_duplicates', playlist_size, lambda: optimizer.remove_duplicates(next(duplicated_iterator)), len(duplicated_setlists)))
+
+    setlist_df = playlist.iloc[setlists[0]]
+    results.append(measure('calculate_setlist_features', playlist_size, lambda: optimizer.calculate_setlist_features(setlist_df), 200))
+
+    clusterer = PlaylistClusterer()
+    results.append(measure('cluster_pipeline', playlist_size, lambda: clusterer.cluster_pipeline(setlist_df.copy()), 20))
+
+    ga_result = measure('run_ga', playlist_size, optimizer.run_ga)
+    ga_result['generations'] = generations
+    ga_result['generations_per_second'] = generations/ga_result['seconds']
+    results.append(ga_result)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--evaluations', type=int, default=2000, help='number of fitness evaluations timed per playlist size')
+    parser.add_argument('--generations', type=int, default=50, help='number of generations of the timed run_ga')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON report path. The report is written to stdout when omitted')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', filter=lambda record: record['name'].startswith('__main__'))
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'parameters': vars(args),
+        'results': [result for size in args.sizes for result in benchmark_playlist(size, args.evaluations, args.generations, args.seed)],
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
@@ -0,0 +1,45 @@
+import pandas as pd
+import numpy as np
+
+GENRES = ['pop', 'rock', 'metal', 'other']
+COUNTRIES = ['BR', 'international']
+DECADES = ['90s', '00s', '10s', 'other']
+PITCH_CLASSES = [None, 'C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+def build_synthetic_playlist(n_tracks:int, seed:int=0, playlist_id:str='synthetic')->pd.DataFrame:
+    '''build a categorized playlist with the same columns SongAnalytics.load_playlist_from_spotify writes to the playlist table,
+    so the optimizer, the clusterer and the categorization stages can be measured offline
+    '''
+    rng = np.random.default_rng(seed)
+    n_artists = max(n_tracks//4, 1)
+    artists = rng.integers(0, n_artists, n_tracks)
+    release_years = rng.integers(1985, 2024, n_tracks)
+
+    return pd.DataFrame({
+        'id': [f'track{seed}x{i:07d}' for i in range(n_tracks)],
+        'name': [f'Song {i}' for i in range(n_tracks)],
+        'artists': [f'Artist {artist}' for artist in artists],
+        'album': [f'Album {artist}-{year}' for artist, year in zip(artists, release_years)],
+        'popularity': rng.integers(0, 101, n_tracks),
+        'preview_url': None,
+        'release_date': [f'{year}-01-01' for year in release_years],
+        'release_date_precision': 'day',
+        'duration_ms': rng.integers(120_000, 420_000, n_tracks),
+        'genres': rng.choice(['rock,alternative rock', 'pop,dance pop', 'metal,nu metal', 'mpb,samba', 'sertanejo'], n_tracks),
+        'danceability': rng.random(n_tracks),
+        'energy': rng.random(n_tracks),
+        'key': rng.choice(PITCH_CLASSES, n_tracks),
+        'loudness': -rng.random(n_tracks)*15,
+        'mode': rng.choice(['Minor', 'Major'], n_tracks),
+        'speechiness': rng.random(n_tracks)*0.3,
+        'acousticness': rng.random(n_tracks),
+        'instrumentalness': rng.random(n_tracks)*0.2,
+        'liveness': rng.random(n_tracks)*0.5,
+        'valence': rng.random(n_tracks),
+        'tempo': rng.uniform(60, 200, n_tracks),
+        'time_signature': rng.choice([3, 4, 5], n_tracks, p=[0.1, 0.85, 0.05]),
+        'playlist_id': playlist_id,
+        'genre': rng.choice(GENRES, n_tracks, p=[0.3, 0.45, 0.2, 0.05]),
+        'country': rng.choice(COUNTRIES, n_tracks, p=[0.4, 0.6]),
+        'decade': rng.choice(DECADES, n_tracks, p=[0.25, 0.45, 0.25, 0.05]),
+    })
@@ -0,0 +1,41 @@
+from database_manager import DatabaseManager
+from sqlalchemy import column
+from loguru import logger
+import hashlib
+import json
+import time
+
+class CategoryCache():
+    '''persistent cache of the LLM categories of each track, in the category_cache table created by DatabaseManager.create_schema.
+    A category depends on the model, the prompt and the allowed categories that produced it, so they are all part of the key:
+    changing any of them misses only the entries made with the old version, which stay stored for when it is switched back
+    '''
+    def __init__(self, database_manager:DatabaseManager, model:str, prompt:str, categories:dict) -> None:
+        self.database_manager = database_manager
+        self.version = {
+            'model': model,
+            'prompt_hash': hashlib.sha256(prompt.encode()).hexdigest(),
+            'categories_hash': hashlib.sha256(json.dumps(categories, sort_keys=True).encode()).hexdigest(),
+        }
+
+    def __conditions(self)->list:
+        return [column(name) == value for name, value in self.version.items()]
+
+    def get(self, track_ids:list[str])->dict:
+        '''categories of the cached tracks, by track id
+        '''
+        rows = self.database_manager.read_in('category_cache', 'track_id', track_ids, ['track_id', 'data'], self.__conditions())
+        cached = {track_id: json.loads(data) for track_id, data in zip(rows['track_id'], rows['data'])}
+        logger.info(f'Category cache: {len(cached)} hits, {len(track_ids) - len(cached)} misses')
+        return cached
+
+    def read_all(self)->dict:
+        '''categories of every track cached for the current version, by track id
+        '''
+        rows = self.database_manager.read_table('category_cache', ['track_id', 'data'], self.__conditions())
+        return {track_id: json.loads(data) for track_id, data in zip(rows['track_id'], rows['data'])}
+
+    def put(self, categories:dict)->None:
+        created_at = time.time()
+        rows = [{'track_id': track_id, **self.version, 'data': json.dumps(track_categories), 'created_at': created_at} for track_id, track_categories in categories.items()]
+        self.database_manager.upsert('category_cache', 'track_id', rows, self.__conditions())
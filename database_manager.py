@@ -0,0 +1,192 @@
+from sqlalchemy import bindparam, column, delete, insert, inspect, select, table, text
+from sqlalchemy.engine import Connection, Engine
+from loguru import logger
+import pandas as pd
+import sqlite3
+import csv
+import io
+
+# field COPY reads as NULL, distinct from the empty string
+COPY_NULL = '\\N'
+
+# bound parameters allowed in a single statement, which caps the rows of a multi-row INSERT
+MAX_BOUND_PARAMETERS = {
+    'sqlite': 32766 if sqlite3.sqlite_version_info >= (3, 32) else 999,
+    'postgresql': 65535,
+}
+
+# lookups by playlist and by track, the playlist table holds every playlist ever loaded
+PLAYLIST_INDEXES = {
+    'ix_playlist_playlist_id': 'playlist_id',
+    'ix_playlist_id': 'id',
+}
+
+class DatabaseManager():
+    '''query layer of the playlist tables. Reads are parameterized and select only the rows and columns asked for, so they scale
+    with the playlist at hand and not with the whole table. Every write runs in a single transaction, so a failure never leaves
+    a table half written, and the rows go in chunks of chunk_size, one multi-row INSERT per chunk, or through COPY when the
+    database is PostgreSQL
+    '''
+    def __init__(self, engine:Engine, chunk_size:int=1000, use_copy:bool=True) -> None:
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.use_copy = use_copy
+        self.create_schema()
+
+    def create_schema(self)->None:
+        '''create the snapshot, Spotify cache and category cache tables and the indexes of the playlist table. The playlist table
+        itself is created by its first write, from the columns of the rows, and gets its indexes then
+        '''
+        with self.engine.begin() as connection:
+            connection.execute(text('CREATE TABLE IF NOT EXISTS playlist_snapshots (playlist_id VARCHAR PRIMARY KEY, snapshot_id VARCHAR)'))
+            for table_name in ['spotify_artist_genres_cache', 'spotify_audio_features_cache']:
+                connection.execute(text(f'CREATE TABLE IF NOT EXISTS {table_name} (id VARCHAR PRIMARY KEY, data TEXT, fetched_at FLOAT NOT NULL)'))
+            connection.execute(text(
+                'CREATE TABLE IF NOT EXISTS category_cache (track_id VARCHAR, model VARCHAR, prompt_hash VARCHAR, categories_hash VARCHAR, '
+                'data TEXT NOT NULL, created_at FLOAT NOT NULL, PRIMARY KEY (track_id, model, prompt_hash, categories_hash))'
+            ))
+            self.__create_playlist_indexes(connection)
+
+    @staticmethod
+    def __create_playlist_indexes(connection:Connection)->None:
+        if inspect(connection).has_table('playlist'):
+            for index_name, column_name in PLAYLIST_INDEXES.items():
+                connection.execute(text(f'CREATE INDEX IF NOT EXISTS {index_name} ON playlist ({column_name})'))
+
+    def has_table(self, table_name:str)->bool:
+        return inspect(self.engine).has_table(table_name)
+
+    def table_columns(self, table_name:str)->list[str]:
+        return [table_column['name'] for table_column in inspect(self.engine).get_columns(table_name)] if self.has_table(table_name) else []
+
+    def __select(self, table_name:str, columns:list[str]|None):
+        columns = self.table_columns(table_name) if columns is None else columns
+        return select(*[column(name) for name in columns]).select_from(table(table_name))
+
+    def read_table(self, table_name:str, columns:list[str]|None=None, conditions:list=[])->pd.DataFrame:
+        return pd.read_sql(self.__select(table_name, columns).where(*conditions), con=self.engine)
+
+    def read_playlist(self, playlist_id:str|None, columns:list[str]|None=None)->pd.DataFrame:
+        '''rows of one playlist, or of every playlist when playlist_id is None
+        '''
+        if not self.has_table('playlist'):
+            return pd.DataFrame(columns=columns)
+        query = self.__select('playlist', columns)
+        if playlist_id is not None:
+            query = query.where(column('playlist_id') == playlist_id)
+        return pd.read_sql(query, con=self.engine)
+
+    def in_chunks(self, values:list, other_parameters:int=0)->list[list]:
+        '''values split in lists short enough to be bound in an IN clause of a statement that binds other_parameters more, within
+        the bound parameters limit of the database
+        '''
+        size = max(1, MAX_BOUND_PARAMETERS.get(self.engine.dialect.name, 2000) - other_parameters)
+        return [values[i:i + size] for i in range(0, len(values), size)]
+
+    def read_in(self, table_name:str, key_column:str, keys:list, columns:list[str]|None=None, conditions:list=[])->pd.DataFrame:
+        '''rows of table_name whose key_column is one of keys and that meet every condition, in as many queries as the bound
+        parameters limit of the database needs
+        '''
+        query = self.__select(table_name, columns).where(*conditions)
+        other_parameters = len(query.compile(dialect=self.engine.dialect).params)
+        query = query.where(column(key_column).in_(bindparam('keys', expanding=True)))
+        chunks = [pd.read_sql(query, con=self.engine, params={'keys': chunk}) for chunk in self.in_chunks(keys, other_parameters)]
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=columns)
+
+    def upsert(self, table_name:str, key_column:str, rows:list[dict], conditions:list=[])->None:
+        '''write rows to table_name, replacing the stored rows with the same key_column among those that meet every condition. Delete
+        and insert in one transaction works on every database, unlike the dialect specific upserts
+        '''
+        if not rows:
+            return
+        target = table(table_name, *[column(name) for name in rows[0]])
+        other_parameters = len(delete(target).where(*conditions).compile(dialect=self.engine.dialect).params)
+        with self.engine.begin() as connection:
+            for chunk in self.in_chunks([row[key_column] for row in rows], other_parameters):
+                connection.execute(delete(target).where(*conditions, column(key_column).in_(chunk)))
+            connection.execute(insert(target), rows)
+
+    def read_tracks(self, track_ids:list[str], playlist_id:str|None=None, columns:list[str]|None=None, not_null:list[str]=[])->pd.DataFrame:
+        '''rows of the given tracks, in any playlist unless playlist_id is given, skipping the rows with nulls in the not_null columns
+        '''
+        conditions = [column(name).is_not(None) for name in not_null]
+        if playlist_id is not None:
+            conditions.append(column('playlist_id') == playlist_id)
+        return self.read_in('playlist', 'id', track_ids, columns, conditions)
+
+    def read_playlist_track_ids(self, playlist_id:str)->set:
+        if not self.has_table('playlist'):
+            return set()
+        with self.engine.connect() as connection:
+            rows = connection.execute(text('SELECT id FROM playlist WHERE playlist_id = :playlist_id'), {'playlist_id': playlist_id})
+            return {row.id for row in rows}
+
+    def read_snapshot_id(self, playlist_id:str)->str|None:
+        with self.engine.connect() as connection:
+            return connection.execute(text('SELECT snapshot_id FROM playlist_snapshots WHERE playlist_id = :playlist_id'), {'playlist_id': playlist_id}).scalar()
+
+    @staticmethod
+    def store_snapshot_id(connection:Connection, playlist_id:str, snapshot_id:str)->None:
+        connection.execute(text('DELETE FROM playlist_snapshots WHERE playlist_id = :playlist_id'), {'playlist_id': playlist_id})
+        connection.execute(text('INSERT INTO playlist_snapshots (playlist_id, snapshot_id) VALUES (:playlist_id, :snapshot_id)'), {'playlist_id': playlist_id, 'snapshot_id': snapshot_id})
+
+    @staticmethod
+    def delete_playlist_rows(connection:Connection, playlist_id:str, track_ids:list[str]|None=None)->None:
+        '''delete the rows of a playlist, only those of track_ids when given, inside the transaction of connection
+        '''
+        if not inspect(connection).has_table('playlist'):
+            return
+        if track_ids is None:
+            connection.execute(text('DELETE FROM playlist WHERE playlist_id = :playlist_id'), {'playlist_id': playlist_id})
+        elif track_ids:
+            connection.execute(
+                text('DELETE FROM playlist WHERE playlist_id = :playlist_id AND id IN :ids').bindparams(bindparam('ids', expanding=True)),
+                {'playlist_id': playlist_id, 'ids': list(track_ids)}
+            )
+
+    @staticmethod
+    def copy_rows(table, connection:Connection, keys:list[str], data_iter)->None:
+        '''pandas insertion method that streams the rows with COPY, for psycopg2 and psycopg 3. csv.writer outputs None and empty
+        strings alike, so None is written as the \\N marker COPY is told to read as NULL, and empty strings stay empty strings
+        '''
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows([COPY_NULL if value is None else value for value in row] for row in data_iter)
+        buffer.seek(0)
+        columns = ', '.join(f'"{key}"' for key in keys)
+        table_name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+        statement = f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')"
+        with connection.connection.cursor() as cursor:
+            if hasattr(cursor, 'copy_expert'):
+                cursor.copy_expert(statement, buffer)
+            else:
+                with cursor.copy(statement) as copy:
+                    copy.write(buffer.read())
+
+    def __write(self, connection:Connection, table_name:str, rows:pd.DataFrame, if_exists:str)->None:
+        dialect = connection.dialect.name
+        if dialect == 'postgresql' and self.use_copy:
+            method, chunk_size = self.copy_rows, self.chunk_size
+        else:
+            method = 'multi'
+            max_parameters = MAX_BOUND_PARAMETERS.get(dialect, 2000)
+            chunk_size = max(1, min(self.chunk_size, max_parameters//max(len(rows.columns), 1)))
+        rows.to_sql(table_name, con=connection, if_exists=if_exists, index=False, chunksize=chunk_size, method=method)
+        if table_name == 'playlist':
+            self.__create_playlist_indexes(connection)
+
+    def append_rows(self, connection:Connection, table_name:str, rows:pd.DataFrame)->None:
+        '''append the rows inside the transaction of connection, creating the table when it does not exist yet
+        '''
+        self.__write(connection, table_name, rows, 'append')
+
+    def replace_table(self, table_name:str, rows:pd.DataFrame)->None:
+        with self.engine.begin() as connection:
+            self.__write(connection, table_name, rows, 'replace')
+
+    def replace_playlist_rows(self, playlist_id:str, rows:pd.DataFrame)->None:
+        '''swap the stored rows of a playlist for rows, atomically
+        '''
+        with self.engine.begin() as connection:
+            self.delete_playlist_rows(connection, playlist_id)
+            self.__write(connection, 'playlist', rows, 'append')
+        logger.info(f'Stored {len(rows)} rows of the playlist {playlist_id}')
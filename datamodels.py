@@ -1,9 +1,19 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 class AIConfigurations(BaseModel):
     model: str
     prompt_templates_filepaths: dict[str, str]
     categories: dict[str, list[str]]
+    chunk_size: int = 100
+    max_input_tokens_per_request: int = 6000
+    max_output_tokens_per_request: int = 4000
+    output_tokens_per_song: int = 40
+    max_concurrent_requests: int = 4
+    max_retries: int = 3
+    # name of a categorizer of ai_categorization.CATEGORIZERS, None sends every song to the LLM
+    categorizer: str | None = 'local'
+    local_min_confidence: float = 0.8
+    local_min_training_rows: int = 50
 
 class DefaultOptimizationParameters(BaseModel):
     max_duration: int
@@ -13,13 +23,77 @@ class DefaultOptimizationParameters(BaseModel):
     max_songs_per_artist: int
     target_features: dict[str, float]
     minimum_popularity: int
+    population_size: int = 100
+    crossover_probability: float = 0.4
+    mutation_probability: float = 0.07
+    generations: int = 210
+    stagnation_generations: int | None = 30
+    target_fitness: float | None = None
+    time_budget_seconds: float | None = None
+    solver: str = 'ga'
+    solver_seed: int | None = 0
+    annealing_iterations: int = Field(20000, ge=1)
+    # the cooling rate is their ratio and the acceptance probability divides by the temperature, so both must be positive
+    annealing_initial_temperature: float = Field(1.0, gt=0)
+    annealing_final_temperature: float = Field(0.001, gt=0)
+
+class IslandModel(BaseModel):
+    islands: int = 1
+    workers: int = 1
+    migration_interval: int = 10
+    migration_size: int = 2
+
+class Instrumentation(BaseModel):
+    enabled: bool = False
+    track_memory: bool = False
+    trace_file: str | None = None
+    profile: bool = False
+    profile_top: int = 25
 
 class General(BaseModel):
     setlist_size: int
     default_playlist_id: str
     default_optimization_parameters: DefaultOptimizationParameters
     Optmization_weights: dict[str, float]
+    island_model: IslandModel = IslandModel()
+    fitness_cache_size: int = 50000
+    instrumentation: Instrumentation = Instrumentation()
+
+class RateLimit(BaseModel):
+    requests_per_second: float = 10
+    burst: int = 20
+    max_retries: int = 5
+    retry_base_delay_seconds: float = 0.5
+    retry_max_delay_seconds: float = 30
+
+class SpotifyConfigurations(BaseModel):
+    max_concurrent_requests: int = 8
+    artists_batch_size: int = 50
+    audio_features_batch_size: int = 100
+    connection_limit: int = 20
+    connection_limit_per_host: int = 10
+    keepalive_timeout_seconds: float = 30
+    dns_cache_ttl_seconds: int = 300
+    request_timeout_seconds: float = 30
+    token_refresh_margin_seconds: float = 60
+    playlist_page_size: int = 100
+    playlist_prefetch_pages: int = 8
+    # must keep total, which gives the offsets of the pages
+    playlist_track_fields: str | None = 'total,items(track(id,name,artists(id,name),album(name,release_date,release_date_precision),popularity,preview_url,duration_ms))'
+    rate_limit: RateLimit = RateLimit()
+    cache_enabled: bool = True
+    cache_ttl_hours: float | None = 720
+    incremental_sync: bool = True
+    pipeline_workers: int = 2
+    pipeline_queue_size: int = 4
+    db_flush_rows: int = 500
+
+class DatabaseConfigurations(BaseModel):
+    chunk_size: int = 1000
+    use_copy: bool = True
 
 class ConfigFile(BaseModel):
     AI_configurations: AIConfigurations
     general: General
+    spotify: SpotifyConfigurations = SpotifyConfigurations()
+    database: DatabaseConfigurations = DatabaseConfigurations()
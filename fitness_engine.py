@@ -0,0 +1,341 @@
+import pandas as pd
+import numpy as np
+from datamodels import DefaultOptimizationParameters
+
+TARGET_FEATURE_COLUMNS = ['danceability', 'energy', 'loudness', 'valence']
+
+# deviation from a target proportion above which the proportion is penalized
+TOLERANCE_L3 = 0.35
+
+class FitnessEngine():
+    '''precompiled version of the setlist fitness function. The playlist is encoded once as integer codes
+    and contiguous float arrays, so each evaluation only does array gathers and np.bincount calls.
+    '''
+    def __init__(self, playlist: pd.DataFrame, default_optimization_parameters: DefaultOptimizationParameters, optmization_weights: dict[str, float]) -> None:
+        self.default_optimization_parameters = default_optimization_parameters
+        self.optmization_weights = optmization_weights
+        self.playlist_size = len(playlist)
+
+        self.duration_ms = self.__to_float_array(playlist['duration_ms'])
+        self.popularity = self.__to_float_array(playlist['popularity'])
+        # one row per feature so the gathered values of each feature are contiguous
+        self.target_features = np.ascontiguousarray(np.vstack([self.__to_float_array(playlist[feature]) for feature in TARGET_FEATURE_COLUMNS]))
+
+        self.genre_codes, self.genre_labels = self.__encode(playlist['genre'])
+        self.country_codes, self.country_labels = self.__encode(playlist['country'])
+        self.decade_codes, self.decade_labels = self.__encode(playlist['decade'])
+        self.artist_codes, self.artist_labels = self.__encode(playlist['artists'])
+        self.id_codes, _ = pd.factorize(playlist['id'], use_na_sentinel=False)
+
+        # (name, codes, number of labels, [(category, code, target proportion)], weight key, missing penalty)
+        self.proportion_checks = [
+            ('genre', self.genre_codes, len(self.genre_labels), self.__resolve_targets(self.genre_labels, default_optimization_parameters.genre_proportion), 'genre_proportion', 1e5),
+            ('country', self.country_codes, len(self.country_labels), self.__resolve_targets(self.country_labels, default_optimization_parameters.country_proportion), 'country_proportion', 1e5),
+            ('decade', self.decade_codes, len(self.decade_labels), self.__resolve_targets(self.decade_labels, default_optimization_parameters.decade_proportion), 'decade_proportion', 1e3),
+        ]
+
+    @staticmethod
+    def __to_float_array(column: pd.Series) -> np.ndarray:
+        return np.ascontiguousarray(pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan))
+
+    @staticmethod
+    def __encode(column: pd.Series) -> tuple[np.ndarray, list]:
+        '''encode a categorical column as integer codes. Missing values go to an extra bucket (code == len(labels))
+        that is never counted, the same way value_counts drops them.
+        '''
+        codes, labels = pd.factorize(column)
+        codes = codes.astype(np.intp)
+        codes[codes < 0] = len(labels)
+        return np.ascontiguousarray(codes), list(labels)
+
+    @staticmethod
+    def __resolve_targets(labels: list, target_proportions: dict[str, float]) -> list[tuple]:
+        '''map each target category to its code. Categories absent from the playlist get None and always count as missing.
+        '''
+        return [(category, labels.index(category) if category in labels else None, proportion) for category, proportion in target_proportions.items()]
+
+    @staticmethod
+    def __nanmean(values: np.ndarray) -> float:
+        count = np.count_nonzero(~np.isnan(values))
+        if count == 0:
+            return np.nan
+        return np.nansum(values)/count
+
+    def evaluate(self, individual: list[int], debug=False) -> tuple[float]:
+        '''function to calculate the fitness score of an individual setlist. The score should be minimized for the genetic algorithm to work properly.
+        '''
+        individual = np.asarray(individual, dtype=np.intp)
+
+        total_duration_minutes = np.nansum(self.duration_ms[individual])/1000/60
+        setlist_popularity = self.__nanmean(self.popularity[individual])
+        selected_features = self.target_features[:, individual]
+        setlist_target_features = {feature: self.__nanmean(selected_features[i]) for i, feature in enumerate(TARGET_FEATURE_COLUMNS)}
+        category_counts = [np.bincount(codes[individual], minlength=n_labels + 1) for _, codes, n_labels, *_ in self.proportion_checks]
+        max_songs_per_artist = self.__batch_max_repeats(self.artist_codes[individual][None, :], len(self.artist_labels))[0]
+        unique_songs = len(np.unique(self.id_codes[individual]))
+
+        return self.__score(total_duration_minutes, setlist_popularity, category_counts, max_songs_per_artist, setlist_target_features, unique_songs, len(individual), debug),
+
+    def __score(self, total_duration_minutes: float, setlist_popularity: float, category_counts: list[np.ndarray], max_songs_per_artist: int,
+                setlist_target_features: dict[str, float], unique_songs: int, setlist_size: int, debug=False) -> float:
+        '''fitness score of a setlist from its aggregated features
+        '''
+        default_optimization_parameters = self.default_optimization_parameters
+        optmization_weights = self.optmization_weights
+
+        # Calculate the fitness score
+        fitness_score = 0
+
+        # Calculate the fitness score based on the total duration of the setlist
+        duration_score = 1-abs(total_duration_minutes - default_optimization_parameters.max_duration)/default_optimization_parameters.max_duration
+        print(f"duration score: {duration_score}") if debug else None
+        fitness_score += abs(optmization_weights['max_duration']*duration_score)
+
+        # Calculate the fitness score based on the popularity of the setlist
+        if setlist_popularity < default_optimization_parameters.minimum_popularity:
+            print(f"popularity score: {setlist_popularity}") if debug else None
+            fitness_score += (default_optimization_parameters.minimum_popularity - setlist_popularity)*optmization_weights['minimum_popularity']
+
+        # Calculate the fitness score based on the genre, country and decade proportions of the setlist
+        for (name, _, n_labels, targets, weight_key, missing_penalty), counts in zip(self.proportion_checks, category_counts):
+            total = counts[:n_labels].sum()
+            for category, code, proportion in targets:
+                count = 0 if code is None else counts[code]
+                if count == 0:
+                    if proportion > 0:
+                        print(f"{name} {category} is missing! equivalent score: {int(missing_penalty)}") if debug else None
+                        fitness_score += missing_penalty
+                    continue
+                difference = abs(count/total - proportion)
+                if difference >= TOLERANCE_L3:
+                    category_score = optmization_weights[weight_key]*difference*1000
+                    print(f"{name} {category} score: {category_score}") if debug else None
+                    fitness_score += category_score
+
+        # Calculate the fitness score based on the maximum number of songs per artist in the setlist
+        if max_songs_per_artist > default_optimization_parameters.max_songs_per_artist:
+            max_songs_per_artist_score = 1-abs(max_songs_per_artist - default_optimization_parameters.max_songs_per_artist)/default_optimization_parameters.max_songs_per_artist
+            print(f"max songs per artist score: {abs(optmization_weights['max_songs_per_artist']*max_songs_per_artist_score)}") if debug else None
+            fitness_score += abs(optmization_weights['max_songs_per_artist']*max_songs_per_artist_score)
+
+        # Calculate the fitness score based on the target features of the setlist
+        for feature, target_value in default_optimization_parameters.target_features.items():
+            feature_score = 1-abs(setlist_target_features.get(feature, 0) - target_value)/target_value
+            print(f"feature {feature} score: {abs(optmization_weights['target_features']*feature_score)}") if debug else None
+            fitness_score += abs(optmization_weights['target_features']*feature_score)
+
+        # Check if the playlist has any repeated songs
+        if unique_songs < setlist_size:
+            print(f"repeated songs score: {1e6*setlist_size - unique_songs}") if debug else None
+            fitness_score += 1e6*setlist_size - unique_songs
+
+        # ensure the fitness score is always positive
+        return max(0, float(fitness_score))
+
+    def statistics(self, individual: list[int]) -> 'SetlistStatistics':
+        '''build the running statistics of an individual, so later song swaps can be scored with evaluate_statistics
+        '''
+        individual = np.asarray(individual, dtype=np.intp)
+        statistics = SetlistStatistics()
+        statistics.size = len(individual)
+
+        duration = self.duration_ms[individual]
+        statistics.duration_sum = np.nansum(duration)
+        popularity = self.popularity[individual]
+        statistics.popularity_sum = np.nansum(popularity)
+        statistics.popularity_count = np.count_nonzero(~np.isnan(popularity))
+        statistics.feature_sums = [np.nansum(self.target_features[i][individual]) for i in range(len(TARGET_FEATURE_COLUMNS))]
+        statistics.feature_counts = [np.count_nonzero(~np.isnan(self.target_features[i][individual])) for i in range(len(TARGET_FEATURE_COLUMNS))]
+        statistics.category_counts = [np.bincount(codes[individual], minlength=n_labels + 1) for _, codes, n_labels, *_ in self.proportion_checks]
+
+        for song in individual:
+            self.__add_artist(statistics, song)
+            song_id = self.id_codes[song]
+            statistics.id_counts[song_id] = statistics.id_counts.get(song_id, 0) + 1
+        return statistics
+
+    def replace_song(self, statistics: 'SetlistStatistics', song_out: int, song_in: int) -> None:
+        '''update the statistics in O(1) when song_out leaves the setlist and song_in takes its place
+        '''
+        if song_out == song_in:
+            return
+        for song, sign in ((song_out, -1), (song_in, 1)):
+            duration = self.duration_ms[song]
+            if not np.isnan(duration):
+                statistics.duration_sum += sign*duration
+            popularity = self.popularity[song]
+            if not np.isnan(popularity):
+                statistics.popularity_sum += sign*popularity
+                statistics.popularity_count += sign
+            for i in range(len(TARGET_FEATURE_COLUMNS)):
+                feature = self.target_features[i][song]
+                if not np.isnan(feature):
+                    statistics.feature_sums[i] += sign*feature
+                    statistics.feature_counts[i] += sign
+            for (_, codes, *_), counts in zip(self.proportion_checks, statistics.category_counts):
+                counts[codes[song]] += sign
+
+            song_id = self.id_codes[song]
+            statistics.id_counts[song_id] = statistics.id_counts.get(song_id, 0) + sign
+            if statistics.id_counts[song_id] == 0:
+                del statistics.id_counts[song_id]
+
+        self.__remove_artist(statistics, song_out)
+        self.__add_artist(statistics, song_in)
+
+    def __add_artist(self, statistics: 'SetlistStatistics', song: int) -> None:
+        artist = self.artist_codes[song]
+        if artist == len(self.artist_labels):
+            return
+        count = statistics.artist_counts.get(artist, 0)
+        statistics.artist_counts[artist] = count + 1
+        if count:
+            statistics.artist_count_frequency[count] -= 1
+        statistics.artist_count_frequency[count + 1] = statistics.artist_count_frequency.get(count + 1, 0) + 1
+        statistics.max_songs_per_artist = max(statistics.max_songs_per_artist, count + 1)
+
+    def __remove_artist(self, statistics: 'SetlistStatistics', song: int) -> None:
+        artist = self.artist_codes[song]
+        if artist == len(self.artist_labels):
+            return
+        count = statistics.artist_counts[artist]
+        if count == 1:
+            del statistics.artist_counts[artist]
+        else:
+            statistics.artist_counts[artist] = count - 1
+            statistics.artist_count_frequency[count - 1] = statistics.artist_count_frequency.get(count - 1, 0) + 1
+        statistics.artist_count_frequency[count] -= 1
+        # the maximum can only drop by one, when its last artist loses a song
+        if count == statistics.max_songs_per_artist and statistics.artist_count_frequency[count] == 0:
+            statistics.max_songs_per_artist = count - 1
+
+    def evaluate_statistics(self, statistics: 'SetlistStatistics') -> tuple[float]:
+        '''fitness score of an individual from its running statistics
+        '''
+        total_duration_minutes = statistics.duration_sum/1000/60
+        setlist_popularity = statistics.popularity_sum/statistics.popularity_count if statistics.popularity_count else np.nan
+        setlist_target_features = {
+            feature: statistics.feature_sums[i]/statistics.feature_counts[i] if statistics.feature_counts[i] else np.nan
+            for i, feature in enumerate(TARGET_FEATURE_COLUMNS)
+        }
+        return self.__score(total_duration_minutes, setlist_popularity, statistics.category_counts, statistics.max_songs_per_artist,
+                            setlist_target_features, len(statistics.id_counts), statistics.size),
+
+    @staticmethod
+    def __batch_nanmean(values: np.ndarray) -> np.ndarray:
+        count = np.count_nonzero(~np.isnan(values), axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(count > 0, np.nansum(values, axis=-1)/count, np.nan)
+
+    @staticmethod
+    def __batch_bincount(codes: np.ndarray, n_labels: int) -> np.ndarray:
+        '''count the codes of every row of a (n_individuals x setlist_size) matrix with a single np.bincount call,
+        shifting each row to its own block of n_labels + 1 bins
+        '''
+        n_individuals = codes.shape[0]
+        offsets = np.arange(n_individuals, dtype=np.intp)[:, None]*(n_labels + 1)
+        counts = np.bincount((codes + offsets).ravel(), minlength=n_individuals*(n_labels + 1))
+        return counts.reshape(n_individuals, n_labels + 1)[:, :n_labels]
+
+    @staticmethod
+    def __batch_max_repeats(codes: np.ndarray, missing_code: int) -> np.ndarray:
+        '''most repeated code of every row of a (n_individuals x setlist_size) matrix, not counting missing_code, from the longest
+        run of equal codes once each row is sorted. Unlike a bincount it costs the same however many labels the codes come from
+        '''
+        n_individuals, setlist_size = codes.shape
+        if setlist_size == 0:
+            return np.zeros(n_individuals, dtype=np.intp)
+        sorted_codes = np.sort(codes, axis=1)
+        positions = np.broadcast_to(np.arange(setlist_size), sorted_codes.shape)
+        run_starts = np.ones(sorted_codes.shape, dtype=bool)
+        run_starts[:, 1:] = sorted_codes[:, 1:] != sorted_codes[:, :-1]
+        run_lengths = positions - np.maximum.accumulate(np.where(run_starts, positions, 0), axis=1) + 1
+        return np.where(sorted_codes != missing_code, run_lengths, 0).max(axis=1)
+
+    def evaluate_population(self, population: np.ndarray) -> np.ndarray:
+        '''function to calculate the fitness score of a whole population at once. The population is a
+        (n_individuals x setlist_size) matrix of playlist positions and the scores match evaluate for every row.
+        '''
+        population = np.asarray(population, dtype=np.intp)
+        if population.ndim != 2:
+            raise ValueError('population must be a (n_individuals x setlist_size) matrix')
+        n_individuals, setlist_size = population.shape
+        default_optimization_parameters = self.default_optimization_parameters
+        optmization_weights = self.optmization_weights
+
+        total_duration_minutes = np.nansum(self.duration_ms[population], axis=1)/1000/60
+        setlist_popularity = self.__batch_nanmean(self.popularity[population])
+        # one gather per feature keeps the same summation order as the single individual evaluation
+        setlist_target_features = {feature: self.__batch_nanmean(self.target_features[i][population]) for i, feature in enumerate(TARGET_FEATURE_COLUMNS)}
+
+        fitness_score = np.zeros(n_individuals)
+
+        # Calculate the fitness score based on the total duration of the setlist
+        duration_score = 1-np.abs(total_duration_minutes - default_optimization_parameters.max_duration)/default_optimization_parameters.max_duration
+        fitness_score += np.abs(optmization_weights['max_duration']*duration_score)
+
+        # Calculate the fitness score based on the popularity of the setlist
+        low_popularity = setlist_popularity < default_optimization_parameters.minimum_popularity
+        fitness_score += np.where(low_popularity, (default_optimization_parameters.minimum_popularity - setlist_popularity)*optmization_weights['minimum_popularity'], 0)
+
+        # Calculate the fitness score based on the genre, country and decade proportions of the setlist
+        for name, codes, n_labels, targets, weight_key, missing_penalty in self.proportion_checks:
+            counts = self.__batch_bincount(codes[population], n_labels)
+            total = counts.sum(axis=1)
+            for category, code, proportion in targets:
+                count = np.zeros(n_individuals, dtype=np.intp) if code is None else counts[:, code]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    difference = np.abs(count/total - proportion)
+                category_score = np.where(difference >= TOLERANCE_L3, optmization_weights[weight_key]*difference*1000, 0)
+                fitness_score += np.where(count == 0, missing_penalty if proportion > 0 else 0, category_score)
+
+        # Calculate the fitness score based on the maximum number of songs per artist in the setlist
+        max_songs_per_artist = self.__batch_max_repeats(self.artist_codes[population], len(self.artist_labels))
+        max_songs_per_artist_score = 1-np.abs(max_songs_per_artist - default_optimization_parameters.max_songs_per_artist)/default_optimization_parameters.max_songs_per_artist
+        fitness_score += np.where(max_songs_per_artist > default_optimization_parameters.max_songs_per_artist, np.abs(optmization_weights['max_songs_per_artist']*max_songs_per_artist_score), 0)
+
+        # Calculate the fitness score based on the target features of the setlist
+        for feature, target_value in default_optimization_parameters.target_features.items():
+            feature_score = 1-np.abs(setlist_target_features.get(feature, 0) - target_value)/target_value
+            fitness_score += np.abs(optmization_weights['target_features']*feature_score)
+
+        # Check if the playlist has any repeated songs
+        sorted_ids = np.sort(self.id_codes[population], axis=1)
+        unique_songs = 1 + np.count_nonzero(sorted_ids[:, 1:] != sorted_ids[:, :-1], axis=1)
+        fitness_score += np.where(unique_songs < setlist_size, 1e6*setlist_size - unique_songs, 0)
+
+        # ensure the fitness score is always positive (a NaN score also becomes 0, like max(0, nan))
+        return np.where(fitness_score > 0, fitness_score, 0.0)
+
+
+class SetlistStatistics():
+    '''sufficient statistics of a setlist: sums and counts of every aggregate used by the fitness function.
+    It only holds plain values, so cloning an individual that carries it stays cheap.
+    '''
+    def __init__(self) -> None:
+        self.size = 0
+        self.duration_sum = 0.0
+        self.popularity_sum = 0.0
+        self.popularity_count = 0
+        self.feature_sums = []
+        self.feature_counts = []
+        self.category_counts = []
+        self.artist_counts = {}
+        # number of artists with each song count, used to keep the maximum up to date in O(1)
+        self.artist_count_frequency = {}
+        self.max_songs_per_artist = 0
+        self.id_counts = {}
+
+    def __deepcopy__(self, memo: dict) -> 'SetlistStatistics':
+        '''the values are immutable scalars, copying the containers is enough. Individuals are cloned every generation,
+        so this avoids a generic deepcopy of each count.
+        '''
+        statistics = SetlistStatistics.__new__(SetlistStatistics)
+        statistics.__dict__.update(self.__dict__)
+        statistics.feature_sums = list(self.feature_sums)
+        statistics.feature_counts = list(self.feature_counts)
+        statistics.category_counts = [counts.copy() for counts in self.category_counts]
+        statistics.artist_counts = dict(self.artist_counts)
+        statistics.artist_count_frequency = dict(self.artist_count_frequency)
+        statistics.id_counts = dict(self.id_counts)
+        return statistics
@@ -0,0 +1,148 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from loguru import logger
+import tracemalloc
+import itertools
+import cProfile
+import pstats
+import time
+import json
+import csv
+import os
+
+# stages the running code is nested in, copied into the asyncio tasks and threads it starts
+open_stages:ContextVar[tuple] = ContextVar('open_stages', default=())
+stage_ids = itertools.count()
+
+class StageProfiler():
+    '''opt-in instrumentation of the pipeline stages. Records wall time, call counts and, optionally, peak traced memory for each stage,
+    plain counters (such as fitness evaluations) and, when profile is set, the hottest functions of a cProfile run.
+    When disabled every method is a no-op, so the stages can always be wrapped.
+    '''
+    def __init__(self, enabled:bool=False, track_memory:bool=False, trace_file:str|None=None, profile:bool=False, profile_top:int=25) -> None:
+        self.enabled = enabled
+        self.track_memory = track_memory
+        self.trace_file = trace_file
+        self.profile = profile
+        self.profile_top = profile_top
+        self.reset()
+
+    def reset(self)->None:
+        self.stages = {}
+        self.counters = {}
+        self.hotspots = []
+        # peak memory seen so far by each open stage, so a stage opening inside another does not hide the peak of the outer one
+        self.__open_peaks = {}
+        # open stages that overlapped a stage other than the ones they are nested in
+        self.__concurrent = set()
+
+    @contextmanager
+    def stage(self, name:str):
+        '''time the code run inside the block as a call of the stage name. Stages may nest and may run concurrently, like the
+        tasks of an asyncio.gather, but tracemalloc has a single peak for the whole process, so the memory of a call that overlapped
+        another stage (other than the ones it is nested in) cannot be told apart. Those calls are counted as concurrent_calls and
+        left out of peak_memory_mb
+        '''
+        if not self.enabled:
+            yield
+            return
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            stage_id = next(stage_ids)
+            enclosing = open_stages.get()
+            overlapping = [other for other in self.__open_peaks if other not in enclosing]
+            if overlapping:
+                self.__concurrent.update(overlapping + [stage_id])
+            # the reset below would lose the peak the open stages reached so far
+            self.__fold_peak(tracemalloc.get_traced_memory()[1])
+            self.__open_peaks[stage_id] = 0
+            tracemalloc.reset_peak()
+            token = open_stages.set(enclosing + (stage_id,))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = None
+            concurrent = False
+            if self.track_memory:
+                open_stages.reset(token)
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, self.__open_peaks.pop(stage_id, 0))
+                self.__fold_peak(peak)
+                if stage_id in self.__concurrent:
+                    self.__concurrent.discard(stage_id)
+                    peak, concurrent = None, True
+                if not self.__open_peaks:
+                    tracemalloc.stop()
+            self.__record(name, elapsed, peak, concurrent)
+
+    def __fold_peak(self, peak:int)->None:
+        for stage_id in self.__open_peaks:
+            self.__open_peaks[stage_id] = max(self.__open_peaks[stage_id], peak)
+
+    def __record(self, name:str, elapsed:float, peak:int|None, concurrent:bool)->None:
+        stage = self.stages.setdefault(name, {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'peak_memory_mb': None, 'concurrent_calls': 0})
+        stage['calls'] += 1
+        stage['total_seconds'] += elapsed
+        stage['max_seconds'] = max(stage['max_seconds'], elapsed)
+        stage['concurrent_calls'] += concurrent
+        if peak is not None:
+            stage['peak_memory_mb'] = max(stage['peak_memory_mb'] or 0, peak/1024**2)
+
+    def count(self, name:str, calls:int=1)->None:
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + calls
+
+    @contextmanager
+    def profile_run(self, name:str):
+        '''wrap a whole run in cProfile and keep its hottest functions, sorted by cumulative time
+        '''
+        if not (self.enabled and self.profile):
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            statistics = pstats.Stats(profiler).sort_stats(pstats.SortKey.CUMULATIVE)
+            self.hotspots = [
+                {
+                    'function': f'{os.path.basename(filename)}:{line}({function})',
+                    'calls': primitive_calls,
+                    'total_seconds': total_time,
+                    'cumulative_seconds': cumulative_time,
+                }
+                for (filename, line, function), (primitive_calls, _, total_time, cumulative_time, _) in
+                sorted(statistics.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.profile_top]
+            ]
+            logger.info(f'Hottest functions of {name}:')
+            for hotspot in self.hotspots:
+                logger.info(f"{hotspot['cumulative_seconds']:10.3f}s {hotspot['calls']:>10} calls  {hotspot['function']}")
+
+    def report(self)->dict:
+        for stage in self.stages.values():
+            stage['mean_seconds'] = stage['total_seconds']/stage['calls']
+        return {'stages': self.stages, 'counters': self.counters, 'hotspots': self.hotspots}
+
+    def write_trace(self)->None:
+        '''write the report to the trace file, as CSV when its extension is .csv and as JSON otherwise
+        '''
+        if not (self.enabled and self.trace_file):
+            return
+        report = self.report()
+        if self.trace_file.endswith('.csv'):
+            with open(self.trace_file, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['type', 'name', 'calls', 'total_seconds', 'mean_seconds', 'max_seconds', 'peak_memory_mb', 'concurrent_calls'])
+                for name, stage in report['stages'].items():
+                    writer.writerow(['stage', name, stage['calls'], stage['total_seconds'], stage['mean_seconds'], stage['max_seconds'], stage['peak_memory_mb'], stage['concurrent_calls']])
+                for name, calls in report['counters'].items():
+                    writer.writerow(['counter', name, calls, None, None, None, None, None])
+        else:
+            with open(self.trace_file, 'w') as f:
+                json.dump(report, f, indent=4)
+        logger.info(f'Instrumentation trace written to {self.trace_file}')
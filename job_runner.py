@@ -0,0 +1,124 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from collections import OrderedDict
+from typing import Callable
+from loguru import logger
+import threading
+import uuid
+import time
+
+# job of the code running now, set by the worker that runs it and copied into the asyncio tasks and threads it starts
+current_job:ContextVar['Job|None'] = ContextVar('current_job', default=None)
+
+class JobCancelled(Exception):
+    pass
+
+def report_progress(stage:str, done:int, total:int|None=None)->None:
+    '''record the progress of a stage of the current job, a no-op outside of jobs. It is also where a cancelled job stops, by
+    raising JobCancelled, so the stages that report progress are the ones that can be cancelled midway
+    '''
+    job = current_job.get()
+    if job is not None:
+        job.report(stage, done, total)
+
+def with_current_job(coroutine):
+    '''coroutine that runs with the job of the caller, for coroutines sent to an event loop running in another thread
+    '''
+    job = current_job.get()
+    async def run():
+        current_job.set(job)
+        return await coroutine
+    return run()
+
+class Job():
+    '''a pipeline stage submitted to the JobRunner. status goes from queued to running and then to done, failed or cancelled, and
+    progress maps each stage that reported to its (done, total) counts, total being None when it is not known up front
+    '''
+    def __init__(self, name:str) -> None:
+        self.id = uuid.uuid4().hex[:8]
+        self.name = name
+        self.status = 'queued'
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self.cancel_requested = threading.Event()
+
+    @property
+    def finished(self)->bool:
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def report(self, stage:str, done:int, total:int|None=None)->None:
+        self.progress[stage] = (done, total)
+        if self.cancel_requested.is_set():
+            raise JobCancelled(f'Job {self.id} ({self.name}) cancelled')
+
+    def cancel(self)->None:
+        '''a queued job never starts, a running one stops at its next progress report
+        '''
+        self.cancel_requested.set()
+        if self.future is not None and self.future.cancel():
+            self.status = 'cancelled'
+            self.finished_at = time.time()
+
+    def run(self, function:Callable, *args, **kwargs)->None:
+        self.status = 'running'
+        self.started_at = time.time()
+        token = current_job.set(self)
+        try:
+            self.result = function(*args, **kwargs)
+            self.status = 'done'
+        except JobCancelled:
+            self.status = 'cancelled'
+            logger.info(f'Job {self.id} ({self.name}) cancelled')
+        except Exception as error:
+            self.status = 'failed'
+            self.error = repr(error)
+            logger.exception(f'Job {self.id} ({self.name}) failed')
+        finally:
+            current_job.reset(token)
+            self.finished_at = time.time()
+        logger.info(f'Job {self.id} ({self.name}) {self.status} in {self.finished_at - self.started_at:.1f}s')
+
+class JobRunner():
+    '''runs the long pipeline stages in a pool of worker threads, so the caller gets a Job back at once and polls its status and
+    progress instead of blocking. Jobs sharing state, like the stages of one SongAnalytics, need a runner with a single worker,
+    which runs them one at a time in submission order. Only the last max_jobs finished jobs are kept
+    '''
+    def __init__(self, max_workers:int=1, max_jobs:int=20) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+
+    def submit(self, name:str, function:Callable, *args, **kwargs)->Job:
+        job = Job(name)
+        self.jobs[job.id] = job
+        job.future = self.executor.submit(job.run, function, *args, **kwargs)
+        logger.info(f'Job {job.id} ({name}) submitted')
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - self.max_jobs, 0)]:
+            del self.jobs[job_id]
+        return job
+
+    def get(self, job_id:str)->Job|None:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id:str)->None:
+        if job_id in self.jobs:
+            self.jobs[job_id].cancel()
+
+    def list_jobs(self)->list[Job]:
+        '''jobs from the newest to the oldest
+        '''
+        return list(reversed(self.jobs.values()))
+
+    def has_active_jobs(self)->bool:
+        return any(not job.finished for job in list(self.jobs.values()))
+
+    def shutdown(self)->None:
+        for job in list(self.jobs.values()):
+            job.cancel()
+        self.executor.shutdown(wait=False)
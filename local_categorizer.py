@@ -0,0 +1,76 @@
+from loguru import logger
+import pandas as pd
+import time
+
+class LocalCategorizer():
+    '''offline categorizer learnt from the rows already categorized. A track is described by keys from three sources: its artists,
+    the Spotify genres of its artists and the decade of its release. For every category each key votes with the label distribution
+    it had in the training rows, and each source is weighted by how well its keys separate the labels of that category in
+    training, so the release decade decides the decade but barely counts for the genre. The confidence of a prediction is the
+    share of the votes of the winning label
+    '''
+    # pseudo counts of the overall label distribution added to every key, so a key seen once does not get a certain vote
+    smoothing = 1.0
+
+    def __init__(self, categories_names:list[str], min_confidence:float=0.8) -> None:
+        self.categories_names = categories_names
+        self.min_confidence = min_confidence
+        self.models = {}
+
+    @staticmethod
+    def track_keys(playlist_df:pd.DataFrame)->pd.DataFrame:
+        '''one row per track position, source and key
+        '''
+        years = pd.to_numeric(playlist_df['release_date'].astype(str).str[:4], errors='coerce')
+        sources = {
+            'artist': playlist_df['artists'].fillna('').astype(str).str.split(','),
+            'genre': playlist_df['genres'].fillna('').astype(str).str.split(','),
+            'release_decade': (years//10*10).astype('Int64').astype(str).map(lambda decade: [decade]),
+        }
+        keys = pd.concat([
+            pd.DataFrame({'row': range(len(playlist_df)), 'source': source, 'key': values.to_numpy()}).explode('key')
+            for source, values in sources.items()
+        ], ignore_index=True)
+        keys['key'] = keys['key'].str.strip()
+        return keys[keys['key'].notna() & (keys['key'] != '') & (keys['key'] != '<NA>')].drop_duplicates()
+
+    def fit(self, training_df:pd.DataFrame):
+        start = time.perf_counter()
+        training_df = training_df.dropna(subset=self.categories_names)
+        keys = self.track_keys(training_df)
+        for category in self.categories_names:
+            labels = keys.join(training_df[category].reset_index(drop=True), on='row')
+            counts = labels.groupby(['source', 'key'])[category].value_counts().unstack(fill_value=0)
+            prior = training_df[category].value_counts(normalize=True).reindex(counts.columns)
+            support = counts.sum(axis=1)
+            probabilities = (counts + self.smoothing*prior).div(support + self.smoothing, axis=0)
+            # purity of a source over its keys, relative to always answering the most common label
+            purity = (probabilities.max(axis=1)*support).groupby(level='source').sum()/support.groupby(level='source').sum()
+            base = prior.max()
+            weights = ((purity - base)/(1 - base)).clip(lower=0) if base < 1 else pd.Series(1.0, index=purity.index)
+            self.models[category] = (probabilities, weights)
+        logger.info(f'Local categorizer trained on {len(training_df)} songs in {time.perf_counter() - start:.3f}s')
+        return self
+
+    def predict(self, playlist_df:pd.DataFrame)->pd.DataFrame:
+        '''label and confidence of every category for each song, in the order of playlist_df. Songs with no known key get no label
+        and a confidence of 0
+        '''
+        keys = self.track_keys(playlist_df)
+        predictions = pd.DataFrame(index=range(len(playlist_df)))
+        for category in self.categories_names:
+            probabilities, weights = self.models[category]
+            votes = keys.join(probabilities, on=['source', 'key'], how='inner')
+            votes = votes.groupby(['row', 'source'])[list(probabilities.columns)].mean()
+            source_weights = votes.index.get_level_values('source').map(weights).to_numpy()
+            scores = votes.mul(source_weights, axis=0).groupby(level='row').sum()
+            scores = scores.div(scores.sum(axis=1), axis=0).dropna()
+            predictions[category] = scores.idxmax(axis=1).reindex(predictions.index)
+            predictions[f'{category}_confidence'] = scores.max(axis=1).reindex(predictions.index).fillna(0.0)
+        predictions.index = playlist_df.index
+        return predictions
+
+    def confident(self, predictions:pd.DataFrame)->pd.Series:
+        '''songs whose every category was predicted with at least min_confidence
+        '''
+        return (predictions[[f'{category}_confidence' for category in self.categories_names]] >= self.min_confidence).all(axis=1)
@@ -1,13 +1,59 @@
 from song_analytics import SongAnalytics
 from datamodels import ConfigFile
 from chart_generator import ChartGenerator
+from job_runner import JobRunner, with_current_job
 import json
 import pandas as pd
 import streamlit as st
+import threading
 import asyncio
+import time
 
 setlist_features_evaluated = False
 
+# seconds between reruns of the script while a background job is running
+JOB_POLL_SECONDS = 1
+BUILD_SETLIST_JOB = "Construir setlist otimizado"
+JOB_STATUS = {'queued': 'na fila', 'running': 'em execução', 'done': 'concluída', 'failed': 'falhou', 'cancelled': 'cancelada'}
+PROGRESS_LABELS = {
+    'pages_fetched': 'Páginas buscadas',
+    'tracks_written': 'Músicas salvas',
+    'chunks_categorized': 'Lotes categorizados',
+    'ga_generations': 'Gerações',
+    'annealing_iterations': 'Iterações',
+}
+
+@st.cache_resource
+def get_event_loop()->asyncio.AbstractEventLoop:
+    '''a single event loop, running in a background thread for the whole life of the app. The Spotify session is bound to the loop
+    that opened it, so running every coroutine here keeps its pooled connections alive across reruns
+    '''
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def run_async(coroutine):
+    # the coroutine takes the job of the caller along, to report its progress from the loop thread
+    return asyncio.run_coroutine_threadsafe(with_current_job(coroutine), get_event_loop()).result()
+
+def show_jobs(job_runner:JobRunner)->None:
+    jobs = job_runner.list_jobs()
+    if not jobs:
+        return
+    st.write("## Tarefas em segundo plano")
+    for job in jobs:
+        st.write(f"**{job.name}** ({job.id}): {JOB_STATUS[job.status]}")
+        for stage, (done, total) in list(job.progress.items()):
+            label = f"{PROGRESS_LABELS.get(stage, stage)}: {done}" + (f"/{total}" if total else "")
+            if total:
+                st.progress(min(done/total, 1.0), text=label)
+            else:
+                st.write(label)
+        if job.status == 'failed':
+            st.error(job.error)
+        if not job.finished and st.button("Cancelar", key=f"cancel_{job.id}"):
+            job.cancel()
+
 def main():
     global setlist_features_evaluated
     logo_path = 'logo7.png'
@@ -21,7 +67,14 @@ def main():
         config = json.load(f)
     config = ConfigFile(**config)
     
-    song_analytics = SongAnalytics()
+    # streamlit reruns the whole script on every click, the analytics object (and its Spotify session) is kept per browser session
+    if 'song_analytics' not in st.session_state:
+        st.session_state.song_analytics = SongAnalytics()
+    song_analytics:SongAnalytics = st.session_state.song_analytics
+    # the long stages run in the background, one at a time since they share song_analytics, and survive the reruns
+    if 'job_runner' not in st.session_state:
+        st.session_state.job_runner = JobRunner(max_workers=1)
+    job_runner:JobRunner = st.session_state.job_runner
 
     # Create a menu to edit the "General" field in the config file
     with st.sidebar:
@@ -79,33 +132,42 @@ def main():
     st.markdown(iframe_code, unsafe_allow_html=True)
     left, right = st.columns(2)
     if left.button("Carregar playlist do spotify",use_container_width=True):
-        asyncio.run(song_analytics.load_playlist_from_spotify(playlist_id))
-        st.success("Playlist carregada com sucesso!")
+        job_runner.submit("Carregar playlist do Spotify", lambda: run_async(song_analytics.load_playlist_from_spotify(playlist_id)))
+        st.info("Carregamento da playlist iniciado")
         
         setlist_features_evaluated = False
     if right.button("Carregar playlist do banco de dados",use_container_width=True):
-        asyncio.run(song_analytics.load_playlist_from_db(playlist_id))
-        st.success("Playlist carregada com sucesso!")
+        job_runner.submit("Carregar playlist do banco de dados", lambda: run_async(song_analytics.load_playlist_from_db(playlist_id)))
+        st.info("Carregamento da playlist iniciado")
         setlist_features_evaluated = False
 
     st.write("Use a opção de análise de playlist após carregá-la o Spotify para adicionar as categorias de música")
     if st.button("Analisar playlist com IA"):
-        song_analytics.categorize_playlist_with_ai(playlist_id)
-        st.success("Playlist categorizada com sucesso!")
+        job_runner.submit("Analisar playlist com IA", song_analytics.categorize_playlist_with_ai, playlist_id)
+        st.info("Categorização da playlist iniciada")
         setlist_features_evaluated = False
 
-    st.write("Use o botão abaixo para gerar um setlist a partir da playlist carregada")
+    st.write("Use o botão abaixo para gerar um setlist a partir da playlist informada acima")
     setlist_name = st.text_input("Nome do setlist", value="Setlist")
     setlist_description = st.text_input("Descrição do setlist", value="Setlist gerado automaticamente")
+    solvers = ['ga', 'annealing']
+    solver = st.selectbox("Algoritmo de otimização", solvers, index=solvers.index(config.general.default_optimization_parameters.solver))
     
     if st.button("Construir setlist otimizado"):
-        song_analytics.build_setlist_from_playlist(setlist_name, setlist_description)
+        job_runner.submit(BUILD_SETLIST_JOB, song_analytics.build_setlist_from_playlist, playlist_id, setlist_name, setlist_description, solver)
+        st.info("Construção do setlist iniciada")
+    last_setlist_job = next((job for job in job_runner.list_jobs() if job.name == BUILD_SETLIST_JOB and job.finished), None)
+    if last_setlist_job is not None and last_setlist_job.status == 'done':
         st.write("Setlist gerado com sucesso!")
-        setlist_df:pd.DataFrame = song_analytics.current_playlist
+        setlist_df:pd.DataFrame = last_setlist_job.result['playlist']
         st.dataframe(setlist_df)
     
+    # these run on the script thread against song_analytics, so they wait until the background jobs using it are over
+    jobs_running = job_runner.has_active_jobs()
+    if jobs_running:
+        st.info("Aguarde o fim das tarefas em segundo plano para carregar ou avaliar o setlist")
     st.write("Carregar setlist já existente")
-    if st.button("Carregar último setlist do banco de dados"):
+    if st.button("Carregar último setlist do banco de dados", disabled=jobs_running):
         song_analytics.load_current_setlist_from_db()
         st.success("Setlist carregado com sucesso!")
         setlist_df:pd.DataFrame = song_analytics.current_playlist
@@ -114,7 +176,7 @@ def main():
 
     st.write("## Avaliação de setlist")
 
-    if st.button("Avaliar setlist"):
+    if st.button("Avaliar setlist", disabled=jobs_running):
         setlist_features_evaluated =True
         if song_analytics.current_playlist is None:
             st.warning("Carregue uma playlist antes de avaliá-la!")
@@ -187,5 +249,10 @@ def main():
                 counter += 1
             st.metric("Pontuação do setlist", round(score,2), score_text)            
 
+    show_jobs(job_runner)
+    if job_runner.has_active_jobs():
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
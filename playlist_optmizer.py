@@ -1,30 +1,149 @@
 import pandas as pd
 import numpy as np
 from datamodels import ConfigFile
+from fitness_engine import FitnessEngine, TARGET_FEATURE_COLUMNS
+from instrumentation import StageProfiler
+from job_runner import report_progress
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from collections import OrderedDict
 import random
 from loguru import logger
 from deap import base, creator, tools
 import json
+import math
+import time
 import os
 
+CATEGORY_COLUMNS = ['genre', 'country', 'decade']
+# the only columns of the playlist table the optimizer reads
+PLAYLIST_COLUMNS = ['id', 'artists', 'duration_ms', 'popularity'] + CATEGORY_COLUMNS + TARGET_FEATURE_COLUMNS
+# optimization parameters used by the fitness function. A change in any of them invalidates the fitness cache
+OBJECTIVE_PARAMETERS = {'max_duration', 'genre_proportion', 'country_proportion', 'decade_proportion', 'max_songs_per_artist', 'target_features', 'minimum_popularity'}
+
+# optimizer owned by each island worker process, created once per run by the pool initializer
+_island_optimizer = None
+
+def _initialize_island_worker(config:ConfigFile, playlist:pd.DataFrame)->None:
+    global _island_optimizer
+    _island_optimizer = PlaylistOptimizer(config)
+    _island_optimizer.load_playlist(playlist)
+
+def _evolve_island(island:list[list], ngen:int, cxpb:float, mutpb:float, seed:int, monitor:'ConvergenceMonitor')->tuple[list[list], list[float]]:
+    random.seed(seed)
+    pop = [creator.Individual(ind) for ind in island]
+    _island_optimizer.assign_fitnesses(pop)
+    pop = _island_optimizer.evolve_population(pop, ngen, cxpb, mutpb, monitor)
+    fitnesses = _island_optimizer.evaluate_population(pop)
+    return [[int(song) for song in ind] for ind in pop], fitnesses.tolist()
+
+class ConvergenceMonitor():
+    '''keeps track of the best fitness across generations and tells the genetic algorithm when to stop:
+    after stagnation_generations generations without improvement, once target_fitness is reached or when the time budget runs out.
+    '''
+    def __init__(self, stagnation_generations:int|None=None, target_fitness:float|None=None, time_budget_seconds:float|None=None) -> None:
+        self.stagnation_generations = stagnation_generations
+        self.target_fitness = target_fitness
+        # wall clock time so the deadline is shared with the island worker processes
+        self.deadline = None if time_budget_seconds is None else time.time() + time_budget_seconds
+        self.best_fitness = float('inf')
+        self.generations = 0
+        self.stagnant_generations = 0
+        self.stop_reason = None
+
+    def for_island(self)->'ConvergenceMonitor':
+        '''monitor used inside an island worker. Stagnation is only tracked globally, by the monitor of the main process.
+        '''
+        monitor = ConvergenceMonitor(target_fitness=self.target_fitness)
+        monitor.deadline = self.deadline
+        return monitor
+
+    def update(self, best_fitness:float, generations:int=1)->bool:
+        '''register the best fitness after running some generations. Returns True when the algorithm should stop.
+        '''
+        self.generations += generations
+        if best_fitness < self.best_fitness:
+            self.best_fitness = best_fitness
+            self.stagnant_generations = 0
+        else:
+            self.stagnant_generations += generations
+
+        if self.target_fitness is not None and self.best_fitness <= self.target_fitness:
+            self.stop_reason = f'target fitness {self.target_fitness} reached'
+        elif self.stagnation_generations is not None and self.stagnant_generations >= self.stagnation_generations:
+            self.stop_reason = f'no improvement in the last {self.stagnant_generations} generations'
+        elif self.deadline is not None and time.time() >= self.deadline:
+            self.stop_reason = 'time budget exhausted'
+        return self.stop_reason is not None
+
+class FitnessCache():
+    '''LRU cache of fitness scores keyed by the sorted playlist positions of a setlist, since the fitness does not depend on the song order
+    '''
+    def __init__(self, max_size:int) -> None:
+        self.max_size = max_size
+        self.scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(individual:list[int])->tuple:
+        return tuple(sorted(int(song) for song in individual))
+
+    def get(self, key:tuple)->float|None:
+        score = self.scores.get(key)
+        if score is None:
+            self.misses += 1
+            return None
+        self.scores.move_to_end(key)
+        self.hits += 1
+        return score
+
+    def put(self, key:tuple, score:float)->None:
+        if self.max_size <= 0:
+            return
+        self.scores[key] = score
+        self.scores.move_to_end(key)
+        if len(self.scores) > self.max_size:
+            self.scores.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self)->None:
+        self.scores.clear()
+
+    def counters(self)->dict:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.scores)}
+
 class PlaylistOptimizer():
-    def __init__(self) -> None:
+    def __init__(self, config:ConfigFile|None=None) -> None:
         self.playlist = None
+        self.fitness_engine = None
 
-        config_file_path = os.getenv('config_file_path')
+        if config is None:
+            config_file_path = os.getenv('config_file_path')
 
-        with open(config_file_path) as f:
-            self.config = json.load(f)
+            with open(config_file_path) as f:
+                config = json.load(f)
 
-        self.config = ConfigFile(**self.config)
+            config = ConfigFile(**config)
+        self.apply_config(config)
+        self.fitness_cache = FitnessCache(self.config.general.fitness_cache_size)
+        # replaced by the profiler of SongAnalytics when the instrumentation is enabled
+        self.profiler = StageProfiler()
+        self.objective_signature = None
+        
+        self.__initate_toolbox()
 
+    def apply_config(self, config:ConfigFile)->None:
+        '''take the general settings of config. The fitness engine and cache are left to refresh_objective, which rebuilds them
+        only when the objective changed
+        '''
+        self.config = config
         for attr, value in self.config.general.model_dump().items():
             setattr(self, attr, value)
         
         self.optmization_weights = self.config.general.Optmization_weights
         self.default_optimization_parameters = self.config.general.default_optimization_parameters
-        
-        self.__initate_toolbox()
 
     # Calculate the features of the setlist
     def calculate_setlist_features(self, setlist: pd.DataFrame)->dict:
@@ -53,6 +172,53 @@ class PlaylistOptimizer():
     def fitness_function(self,individual:list[list],debug=False)->float:
         '''function to calculate the fitness score of an individual setlist. The score should be minimized for the genetic algorithm to work properly.
         '''
+        self.profiler.count('fitness_calls')
+        if debug:
+            return self.fitness_engine.evaluate(individual, debug=debug)
+        key = self.fitness_cache.key(individual)
+        score = self.fitness_cache.get(key)
+        if score is None:
+            self.profiler.count('fitness_engine_evaluations')
+            score = self.fitness_engine.evaluate(individual)[0]
+            self.fitness_cache.put(key, score)
+        return score,
+
+    def evaluate_population(self, population:list[list])->np.ndarray:
+        '''function to calculate the fitness scores of a list of individuals. Cached setlists are looked up
+        and the remaining ones are evaluated in a single vectorized pass
+        '''
+        self.profiler.count('fitness_calls', len(population))
+        keys = [self.fitness_cache.key(individual) for individual in population]
+        scores = np.empty(len(keys))
+        missing = []
+        for i, key in enumerate(keys):
+            score = self.fitness_cache.get(key)
+            if score is None:
+                missing.append(i)
+            else:
+                scores[i] = score
+        if missing:
+            self.profiler.count('fitness_engine_evaluations', len(missing))
+            computed_scores = self.fitness_engine.evaluate_population(np.asarray([population[i] for i in missing], dtype=np.intp))
+            for i, score in zip(missing, computed_scores):
+                scores[i] = score
+                self.fitness_cache.put(keys[i], float(score))
+        return scores
+
+    def refresh_objective(self)->None:
+        '''rebuild the fitness engine and invalidate the fitness cache when the optimization weights or parameters changed since the last run
+        '''
+        signature = json.dumps([self.optmization_weights, self.default_optimization_parameters.model_dump(include=OBJECTIVE_PARAMETERS)], sort_keys=True)
+        if signature == self.objective_signature:
+            return
+        self.objective_signature = signature
+        self.fitness_cache.clear()
+        if self.playlist is not None:
+            self.fitness_engine = FitnessEngine(self.playlist, self.default_optimization_parameters, self.optmization_weights)
+
+    def pandas_fitness_function(self,individual:list[list],debug=False)->float:
+        '''DataFrame based fitness function, kept as the reference implementation to verify the scores of the fitness engine.
+        '''
        
         current_setlist = self.playlist.iloc[individual]
         total_duration_minutes = current_setlist['duration_ms'].sum()/1000/60
@@ -170,8 +336,10 @@ class PlaylistOptimizer():
     def __initate_toolbox(self)->None:
         logger.info('Initializing genetic algorithm toolbox')
         # Define the genetic algorithm functions
-        creator.create("FitnessMin", base.Fitness, weights=(-1.0,))
-        creator.create("Individual", list, fitness=creator.FitnessMin)
+        # the deap classes are global, create them only once per process
+        if not hasattr(creator, 'Individual'):
+            creator.create("FitnessMin", base.Fitness, weights=(-1.0,))
+            creator.create("Individual", list, fitness=creator.FitnessMin, statistics=None)
 
         toolbox = base.Toolbox()
         toolbox.register("individual", tools.initIterate, creator.Individual, self.create_individual)
@@ -186,51 +354,107 @@ class PlaylistOptimizer():
 
     def load_playlist(self, playlist: pd.DataFrame) -> None:
         self.playlist = playlist
-
-    def remove_duplicates(self, individual:list|tuple)->tuple:
+        logger.info('Encoding playlist for the fitness engine')
+        # a new playlist needs a new engine and an empty cache even when the objective is the same
+        self.objective_signature = None
+        self.refresh_objective()
+        self.__build_song_pools()
+
+    def __build_song_pools(self)->None:
+        '''precompute the playlist positions of every genre, country, decade and (genre, country, decade) combination,
+        so the mutation and repair operators never have to scan the whole playlist
+        '''
+        positions = pd.RangeIndex(len(self.playlist))
+        self.song_categories = {column: self.playlist[column].to_numpy() for column in CATEGORY_COLUMNS}
+        self.song_pools = {
+            column: {category: songs.tolist() for category, songs in pd.Series(positions).groupby(self.song_categories[column]).indices.items()}
+            for column in CATEGORY_COLUMNS
+        }
+        combined = pd.Series(positions).groupby([self.song_categories[column] for column in CATEGORY_COLUMNS]).indices
+        self.song_pools['combination'] = {category: songs.tolist() for category, songs in combined.items()}
+        self.all_songs = list(range(len(self.playlist)))
+
+    @staticmethod
+    def __draw_song(pool:list[int], excluded:set[int])->int|None:
+        '''draw a random song of the pool that is not in excluded. Large pools use rejection sampling,
+        so the cost depends on the setlist size instead of the pool size.
+        '''
+        if len(pool) > 2*len(excluded):
+            for _ in range(8):
+                song = pool[random.randrange(len(pool))]
+                if song not in excluded:
+                    return song
+        candidates = [song for song in pool if song not in excluded]
+        return random.choice(candidates) if candidates else None
+
+    def __draw_from_categories(self, column:str, categories:set, excluded:set[int])->int:
+        '''draw a song of any of the given categories that is not in excluded, falling back to the whole playlist
+        '''
+        pools = [self.song_pools[column][category] for category in categories if category in self.song_pools[column]]
+        # weight each pool by its size, so every available song is equally likely
+        pools.sort(key=lambda pool: random.random()**(1/len(pool)), reverse=True)
+        for pool in pools:
+            song = self.__draw_song(pool, excluded)
+            if song is not None:
+                return song
+        return self.__draw_song(self.all_songs, excluded)
+
+    def remove_duplicates(self, individual:list|tuple)->list:
+        '''replace, in place, every song whose id is already in the setlist by another song with the same genre, country and decade
+        '''
         if type(individual) == tuple:
-            individual = list(individual[0])
-        current_setlist = self.playlist.iloc[individual]
-
-        repeated_songs = current_setlist[current_setlist.duplicated(subset='id')]
+            individual = individual[0]
+        song_ids = self.fitness_engine.id_codes
+
+        first_song_per_id = {}
+        repeated_songs = []
+        for song in individual:
+            if song_ids[song] in first_song_per_id:
+                repeated_songs.append(first_song_per_id[song_ids[song]])
+            else:
+                first_song_per_id[song_ids[song]] = song
 
-        if repeated_songs.empty:
+        if not repeated_songs:
             return individual
-        
-        for song in repeated_songs['id']:
-            repeated_song_genre = current_setlist[current_setlist['id'] == song]['genre'].values[0]
-            repeated_song_country = current_setlist[current_setlist['id'] == song]['country'].values[0]
-            repeated_song_decade = current_setlist[current_setlist['id'] == song]['decade'].values[0]
-
-            repeated_song_index = current_setlist[current_setlist['id'] == song].index[0]
-            individual.remove(repeated_song_index)
-            available_songs:pd.DataFrame = self.playlist[
-                (self.playlist['genre'] == repeated_song_genre) &
-                (self.playlist['country'] == repeated_song_country) &
-                (self.playlist['decade'] == repeated_song_decade) &
-                (~self.playlist.index.isin(individual))
-            ]
-            if available_songs.empty:
-                available_songs = self.playlist[~self.playlist.index.isin(individual)]
-            new_song = random.choice(available_songs.index.to_list())
+
+        members = set(individual)
+        for repeated_song in repeated_songs:
+            individual.remove(repeated_song)
+            if repeated_song not in individual:
+                members.discard(repeated_song)
+            combination = tuple(self.song_categories[column][repeated_song] for column in CATEGORY_COLUMNS)
+            new_song = self.__draw_song(self.song_pools['combination'].get(combination, []), members)
+            if new_song is None:
+                new_song = self.__draw_song(self.all_songs, members)
             individual.append(new_song)
+            members.add(new_song)
+            self.__record_swap(individual, repeated_song, new_song)
 
-        return individual,
+        return individual
     
     def __mutateRandomSong(self,individual:list[list], indpb):
-        size = len(individual)
-        available_songs = self.playlist[~self.playlist.index.isin(individual)]
-        for i in range(size):
+        members = set(individual)
+        for i in range(len(individual)):
             if random.random() < indpb:
-                
-                new_song = random.choice(available_songs.index.to_list())
+                new_song = self.__draw_song(self.all_songs, members)
+                if new_song is None:
+                    continue
+                self.__record_swap(individual, individual[i], new_song)
                 individual[i] = new_song
+                members.add(new_song)
         
         individual = self.remove_duplicates(individual)
         individual = self.__check_for_missing_features(individual)
 
         return individual,
 
+    def __record_swap(self, individual:list, song_out:int, song_in:int)->None:
+        '''keep the running statistics of an individual in sync with an in-place song swap, so its fitness can be updated in O(1)
+        '''
+        statistics = getattr(individual, 'statistics', None)
+        if statistics is not None:
+            self.fitness_engine.replace_song(statistics, song_out, song_in)
+
     def __cxTwoPoint(self,ind1:dict, ind2:dict):
         size = min(len(ind1), len(ind2))
         cxpoint1 = random.randint(1, size)
@@ -254,112 +478,298 @@ class PlaylistOptimizer():
 
     # Define the initial population
     def create_individual(self):
-        return random.sample(self.playlist.index.to_list(), self.setlist_size)
+        return random.sample(self.all_songs, self.setlist_size)
+
+    def assign_fitnesses(self, individuals:list[list])->None:
+        '''evaluate a list of individuals in a single batch and store the scores in their fitness
+        '''
+        if not individuals:
+            return
+        fitnesses = self.evaluate_population(individuals)
+        for ind, fit in zip(individuals, fitnesses):
+            ind.fitness.values = fit,
+
+    def evolve_population(self, pop:list[list], ngen:int, cxpb:float, mutpb:float, monitor:ConvergenceMonitor|None=None)->list[list]:
+        '''run up to ngen generations of selection, crossover and mutation over an already evaluated population.
+        When a monitor is given, the loop stops as soon as it reports convergence.
+        '''
+        for g in range(ngen):
+            with self.profiler.stage('ga_generation'):
+                # Select the next generation individuals
+                logger.info(f'Running generation {g}')
+                offspring = self.toolbox.select(pop, len(pop))
+                # Clone the selected individuals
+                offspring = list(map(self.toolbox.clone, offspring))
+
+                # Apply crossover and mutation on the offspring
+                for child1, child2 in zip(offspring[::2], offspring[1::2]):
+                    if random.random() < cxpb:
+                        # the swapped slices invalidate the statistics copied from the parents, and the repairs inside mate
+                        # must not update them
+                        child1.statistics = None
+                        child2.statistics = None
+                        self.toolbox.mate(child1, child2)
+                        del child1.fitness.values
+                        del child2.fitness.values
+
+                # mutations only swap a few songs, so the fitness is updated from the running statistics of the individual
+                for mutant in offspring:
+                    if random.random() < mutpb:
+                        if mutant.statistics is None:
+                            mutant.statistics = self.fitness_engine.statistics(mutant)
+                        self.toolbox.mutate(mutant)
+                        mutant.fitness.values = self.fitness_engine.evaluate_statistics(mutant.statistics)
+                        self.profiler.count('fitness_delta_evaluations')
+
+                # Evaluate the individuals with an invalid fitness
+                invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+                self.assign_fitnesses(invalid_ind)
+
+                # The population is entirely replaced by the offspring
+                logger.info(f'Generation {g} completed')
+                pop[:] = offspring
+            report_progress('ga_generations', g + 1, ngen)
+
+            if monitor is not None and monitor.update(min(ind.fitness.values[0] for ind in pop)):
+                logger.info(f'Stopping at generation {g}: {monitor.stop_reason}')
+                break
+        return pop
+
+    def create_convergence_monitor(self)->ConvergenceMonitor:
+        parameters = self.default_optimization_parameters
+        return ConvergenceMonitor(parameters.stagnation_generations, parameters.target_fitness, parameters.time_budget_seconds)
 
     # Implement the main genetic algorithm loop
     def run_ga(self):
+        self.refresh_objective()
+        if self.config.general.island_model.islands > 1:
+            return self.run_island_ga()
+
         logger.info('Running genetic algorithm')
-        pop = self.toolbox.population(n=100)
-        CXPB, MUTPB, NGEN = 0.4, 0.07, 210
+        parameters = self.default_optimization_parameters
+        monitor = self.create_convergence_monitor()
+        pop = self.toolbox.population(n=parameters.population_size)
 
         # Evaluate the entire population
         logger.info('Evaluating initial population')
-        fitnesses = list(map(self.toolbox.evaluate, pop))
-        for ind, fit in zip(pop, fitnesses):
-            ind.fitness.values = fit
-
-        for g in range(NGEN):
-            # Select the next generation individuals
-            logger.info(f'Running generation {g}')
-            offspring = self.toolbox.select(pop, len(pop))
-            # Clone the selected individuals
-            offspring = list(map(self.toolbox.clone, offspring))
-
-            # Apply crossover and mutation on the offspring
-            for child1, child2 in zip(offspring[::2], offspring[1::2]):
-                if random.random() < CXPB:
-                    self.toolbox.mate(child1, child2)
-                    del child1.fitness.values
-                    del child2.fitness.values
-
-            for mutant in offspring:
-                if random.random() < MUTPB:
-                    self.toolbox.mutate(mutant)
-                    del mutant.fitness.values
-
-            # Evaluate the individuals with an invalid fitness
-            invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-            fitnesses = map(self.toolbox.evaluate, invalid_ind)
-            for ind, fit in zip(invalid_ind, fitnesses):
-                ind.fitness.values = fit
-
-            # The population is entirely replaced by the offspring
-            logger.info(f'Generation {g} completed')
-            pop[:] = offspring
+        self.assign_fitnesses(pop)
+
+        pop = self.evolve_population(pop, parameters.generations, parameters.crossover_probability, parameters.mutation_probability, monitor)
 
         # Find the best individual in the population after the genetic algorithm is complete
         logger.info('Genetic algorithm complete. Finding best individual')
-        result = max(pop, key=self.toolbox.evaluate)
+        fitnesses = self.evaluate_population(pop)
+        result = pop[int(np.argmin(fitnesses))]
+        logger.info(f'Fitness cache: {self.fitness_cache.counters()}')
         return result
-    
-    def __check_for_missing_features(self, individual:list|tuple)->tuple:
-        if type(individual) == tuple:
-            individual = list(individual[0])
-        current_setlist = self.playlist.iloc[individual]
 
-        genres_to_check = {genre: proportion for genre, proportion in self.default_optimization_parameters.genre_proportion.items() if proportion > 0}
-        missing_genres = set(genres_to_check.keys()) - set(current_setlist['genre'].unique())
-        
-        if missing_genres:
-            current_genres = current_setlist['genre'].value_counts()
-            most_frequent_genre = current_genres.idxmax()
-            songs_to_remove = current_setlist[current_setlist['genre'] == most_frequent_genre].index.to_list()
-            available_songs:pd.DataFrame = self.playlist[
-            (self.playlist['genre'].isin(missing_genres)) &
-            (~self.playlist.index.isin(individual))
-            ]
-            if available_songs.empty:
-                available_songs = self.playlist[~self.playlist.index.isin(individual)]
-            song_to_remove = random.choice(songs_to_remove)
-            individual.remove(song_to_remove)
-            new_song = random.choice(available_songs.index.to_list())
-            individual.append(new_song)
-        
-        countries_to_check = {country: proportion for country, proportion in self.default_optimization_parameters.country_proportion.items() if proportion > 0}
-        missing_countries = set(countries_to_check.keys()) - set(current_setlist['country'].unique())
+    def run_island_ga(self):
+        '''island model version of the genetic algorithm. Each island evolves its own population in a worker process
+        and every migration_interval generations the best individuals of each island replace the worst ones of the next island (ring topology).
+        The playlist is sent to the workers once, when the process pool starts. The workers are spawned rather than forked, since
+        forking a process with other threads running, like the app with its jobs and event loop, can deadlock the children.
+        '''
+        island_model = self.config.general.island_model
+        parameters = self.default_optimization_parameters
+        monitor = self.create_convergence_monitor()
+        logger.info(f'Running island genetic algorithm with {island_model.islands} islands and {island_model.workers} workers')
+
+        islands = []
+        for _ in range(island_model.islands):
+            pop = self.toolbox.population(n=parameters.population_size)
+            islands.append([list(ind) for ind in pop])
+
+        remaining_generations = parameters.generations
+        with ProcessPoolExecutor(
+            max_workers=island_model.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_initialize_island_worker,
+            initargs=(self.config, self.playlist)
+        ) as executor:
+            while remaining_generations > 0:
+                epoch_generations = min(island_model.migration_interval, remaining_generations)
+                futures = [
+                    executor.submit(_evolve_island, island, epoch_generations, parameters.crossover_probability, parameters.mutation_probability, random.randrange(2**32), monitor.for_island())
+                    for island in islands
+                ]
+                with self.profiler.stage('island_epoch'):
+                    results = [future.result() for future in futures]
+                remaining_generations -= epoch_generations
+                logger.info(f'{parameters.generations - remaining_generations}/{parameters.generations} generations completed on every island')
+                report_progress('ga_generations', parameters.generations - remaining_generations, parameters.generations)
+
+                islands = [island for island, _ in results]
+                fitnesses = [np.asarray(island_fitnesses) for _, island_fitnesses in results]
+                if monitor.update(min(island_fitnesses.min() for island_fitnesses in fitnesses), epoch_generations):
+                    logger.info(f'Stopping island genetic algorithm: {monitor.stop_reason}')
+                    break
+                if remaining_generations > 0:
+                    islands = self.__migrate(islands, fitnesses, island_model.migration_size)
+
+        # Find the best individual across every island
+        logger.info('Island genetic algorithm complete. Finding best individual')
+        population = [ind for island in islands for ind in island]
+        fitnesses = self.evaluate_population(population)
+        result = creator.Individual(population[int(np.argmin(fitnesses))])
+        return result
 
-        if missing_countries:
-            current_countries = current_setlist['country'].value_counts()
-            most_frequent_country = current_countries.idxmax()
-            songs_to_remove = current_setlist[current_setlist['country'] == most_frequent_country].index.to_list()
-            song_to_remove = random.choice(songs_to_remove)
-            individual.remove(song_to_remove)
-            available_songs:pd.DataFrame = self.playlist[
-            (self.playlist['country'].isin(missing_countries)) &
-            (~self.playlist.index.isin(individual))
-            ]
-            if available_songs.empty:
-                available_songs = self.playlist[~self.playlist.index.isin(individual)]
-            new_song = random.choice(available_songs.index.to_list())
-            individual.append(new_song)
+    @staticmethod
+    def __migrate(islands:list[list[list]], fitnesses:list[np.ndarray], migration_size:int)->list[list[list]]:
+        migrants = [[island[i] for i in np.argsort(island_fitnesses, kind='stable')[:migration_size]] for island, island_fitnesses in zip(islands, fitnesses)]
+        for target in range(len(islands)):
+            source = (target - 1) % len(islands)
+            worst = np.argsort(fitnesses[target], kind='stable')[::-1][:migration_size]
+            for position, migrant in zip(worst, migrants[source]):
+                islands[target][position] = list(migrant)
+        return islands
+
+    def run_solver(self, solver:str|None=None):
+        '''build the setlist with the given solver backend ('ga' or 'annealing'). Defaults to the solver in the config file
+        '''
+        solver = solver or self.default_optimization_parameters.solver
+        solvers = {
+            'ga': self.run_ga,
+            'annealing': self.run_simulated_annealing,
+        }
+        if solver not in solvers:
+            raise ValueError(f'Unknown solver {solver}. Available solvers: {list(solvers)}')
+        return solvers[solver]()
 
-        decades_to_check = {decade: proportion for decade, proportion in self.default_optimization_parameters.decade_proportion.items() if proportion > 0}
-        missing_decades = set(decades_to_check.keys()) - set(current_setlist['decade'].unique())
+    def greedy_setlist(self)->list[int]:
+        '''deterministic construction of a setlist: the (genre, country, decade) quotas implied by the target proportions
+        are filled with the most popular songs, skipping repeated songs and artists that already reached the cap
+        '''
+        parameters = self.default_optimization_parameters
+        size = self.setlist_size
 
-        if missing_decades:
-            current_decades = current_setlist['decade'].value_counts()
-            most_frequent_decade = current_decades.idxmax()
-            songs_to_remove = current_setlist[current_setlist['decade'] == most_frequent_decade].index.to_list()
+        # quota of each combination, rounded with the largest remainder method
+        quotas = {
+            combination: parameters.genre_proportion.get(combination[0], 0)*parameters.country_proportion.get(combination[1], 0)*parameters.decade_proportion.get(combination[2], 0)*size
+            for combination in self.song_pools['combination']
+        }
+        rounded_quotas = {combination: int(quota) for combination, quota in quotas.items()}
+        remaining = min(size, round(sum(quotas.values()))) - sum(rounded_quotas.values())
+        for combination in sorted(quotas, key=lambda combination: quotas[combination] - rounded_quotas[combination], reverse=True)[:max(remaining, 0)]:
+            rounded_quotas[combination] += 1
+
+        popularity = np.nan_to_num(self.fitness_engine.popularity, nan=-1)
+        by_popularity = lambda songs: sorted(songs, key=lambda song: popularity[song], reverse=True)
+        setlist, used_ids, artist_counts = [], set(), {}
+
+        def add_songs(candidates:list[int], quota:int, respect_artist_cap:bool)->None:
+            added = 0
+            for song in candidates:
+                if added == quota or len(setlist) == size:
+                    return
+                song_id = self.fitness_engine.id_codes[song]
+                artist = self.fitness_engine.artist_codes[song]
+                if song_id in used_ids:
+                    continue
+                if respect_artist_cap and artist_counts.get(artist, 0) >= parameters.max_songs_per_artist:
+                    continue
+                setlist.append(song)
+                used_ids.add(song_id)
+                artist_counts[artist] = artist_counts.get(artist, 0) + 1
+                added += 1
+
+        for combination, quota in sorted(rounded_quotas.items(), key=lambda item: item[1], reverse=True):
+            if quota > 0:
+                add_songs(by_popularity(self.song_pools['combination'][combination]), quota, True)
+
+        # fill what is left with the most popular songs, relaxing the artist cap only if needed
+        all_songs_by_popularity = by_popularity(self.all_songs)
+        add_songs(all_songs_by_popularity, size - len(setlist), True)
+        add_songs(all_songs_by_popularity, size - len(setlist), False)
+        return setlist
+
+    def run_simulated_annealing(self):
+        '''simulated annealing over single song swaps, starting from the greedy setlist. Each move is scored in O(1)
+        with the running statistics of the fitness engine, so it optimizes exactly the same objective as fitness_function.
+        The search is deterministic for a given solver_seed.
+        '''
+        logger.info('Running simulated annealing')
+        self.refresh_objective()
+        parameters = self.default_optimization_parameters
+        engine = self.fitness_engine
+        rng = random.Random(parameters.solver_seed)
+        deadline = None if parameters.time_budget_seconds is None else time.time() + parameters.time_budget_seconds
+
+        current = self.greedy_setlist()
+        members = set(current)
+        statistics = engine.statistics(current)
+        current_fitness = engine.evaluate_statistics(statistics)[0]
+        best, best_fitness = list(current), current_fitness
+        logger.info(f'Greedy setlist fitness: {current_fitness}')
+
+        iterations = parameters.annealing_iterations
+        temperature = parameters.annealing_initial_temperature
+        cooling_rate = (parameters.annealing_final_temperature/parameters.annealing_initial_temperature)**(1/max(iterations - 1, 1))
+        for iteration in range(iterations):
+            if iteration % 1000 == 0:
+                report_progress('annealing_iterations', iteration, iterations)
+            if deadline is not None and iteration % 1000 == 0 and time.time() >= deadline:
+                logger.info(f'Stopping simulated annealing at iteration {iteration}: time budget exhausted')
+                break
+            position = rng.randrange(len(current))
+            song_out = current[position]
+            # half of the moves keep the genre, country and decade of the song that leaves the setlist
+            if rng.random() < 0.5:
+                combination = tuple(self.song_categories[column][song_out] for column in CATEGORY_COLUMNS)
+                pool = self.song_pools['combination'].get(combination) or self.all_songs
+            else:
+                pool = self.all_songs
+            song_in = pool[rng.randrange(len(pool))]
+            temperature *= cooling_rate
+            if song_in in members:
+                continue
+
+            engine.replace_song(statistics, song_out, song_in)
+            fitness = engine.evaluate_statistics(statistics)[0]
+            self.profiler.count('fitness_delta_evaluations')
+            delta = fitness - current_fitness
+            if delta <= 0 or rng.random() < math.exp(-delta/temperature):
+                current[position] = song_in
+                members.discard(song_out)
+                members.add(song_in)
+                current_fitness = fitness
+                if fitness < best_fitness:
+                    best, best_fitness = list(current), fitness
+            else:
+                engine.replace_song(statistics, song_in, song_out)
+
+        logger.info(f'Simulated annealing complete. Best fitness: {best_fitness}')
+        return creator.Individual(best)
+
+    def __check_for_missing_features(self, individual:list|tuple)->list:
+        '''for every genre, country and decade with a positive target proportion that is missing from the setlist,
+        replace, in place, a song of the most frequent category by a song of a missing one
+        '''
+        if type(individual) == tuple:
+            individual = individual[0]
+        target_proportions = {
+            'genre': self.default_optimization_parameters.genre_proportion,
+            'country': self.default_optimization_parameters.country_proportion,
+            'decade': self.default_optimization_parameters.decade_proportion,
+        }
+
+        for column in CATEGORY_COLUMNS:
+            categories = self.song_categories[column]
+            current_categories = [categories[song] for song in individual]
+            categories_to_check = {category for category, proportion in target_proportions[column].items() if proportion > 0}
+            missing_categories = categories_to_check - set(current_categories)
+            if not missing_categories:
+                continue
+
+            category_counts = pd.Series(current_categories).value_counts()
+            if category_counts.empty:
+                continue
+            most_frequent_category = category_counts.idxmax()
+            songs_to_remove = [song for song, category in zip(individual, current_categories) if category == most_frequent_category]
             song_to_remove = random.choice(songs_to_remove)
             individual.remove(song_to_remove)
-            available_songs:pd.DataFrame = self.playlist[
-            (self.playlist['decade'].isin(missing_decades)) &
-            (~self.playlist.index.isin(individual))
-            ]
-            if available_songs.empty:
-                available_songs = self.playlist[~self.playlist.index.isin(individual)]
-            new_song = random.choice(available_songs.index.to_list())
+            members = set(individual)
+            new_song = self.__draw_from_categories(column, missing_categories, members)
             individual.append(new_song)
+            self.__record_swap(individual, song_to_remove, new_song)
 
-        return individual,
-        
+        return individual
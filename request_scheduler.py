@@ -0,0 +1,123 @@
+from typing import Awaitable, Callable
+from loguru import logger
+import aiohttp
+import asyncio
+import random
+import time
+
+class RequestScheduler():
+    '''central point every Spotify request goes through. A token bucket keeps the request rate under requests_per_second
+    (with bursts of up to burst requests), a 429 pauses every request for the Retry-After the API sent back, and 5xx responses
+    or connection errors are retried with exponential backoff and full jitter. A 401 refreshes the access token and retries once.
+    '''
+    def __init__(self, requests_per_second:float=10, burst:int=20, max_retries:int=5, retry_base_delay_seconds:float=0.5, retry_max_delay_seconds:float=30) -> None:
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.retry_base_delay_seconds = retry_base_delay_seconds
+        self.retry_max_delay_seconds = retry_max_delay_seconds
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        # requests held back right now, and since when at least one is
+        self.waiting = 0
+        self.waiting_since = 0.0
+        self.reset_metrics()
+
+    def reset_metrics(self)->None:
+        '''throttled_seconds is wall-clock time during which at least one request was held back, so concurrent waits count once
+        and it compares with the elapsed time requests_per_second is computed over
+        '''
+        self.requests = 0
+        self.retries = 0
+        self.throttled_responses = 0
+        self.throttled_seconds = 0.0
+        self.waiting_since = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+    async def __acquire(self)->None:
+        '''wait until both the Retry-After pause is over and the bucket has a token. There is no await between the refill and
+        the withdrawal, so the bucket needs no lock
+        '''
+        waiting = False
+        try:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated_at)*self.requests_per_second)
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens)/self.requests_per_second
+                if not waiting:
+                    waiting = True
+                    if self.waiting == 0:
+                        self.waiting_since = now
+                    self.waiting += 1
+                await asyncio.sleep(wait)
+        finally:
+            if waiting:
+                self.waiting -= 1
+                if self.waiting == 0:
+                    self.throttled_seconds += time.monotonic() - self.waiting_since
+
+    def __backoff(self, attempt:int)->float:
+        return random.uniform(0, min(self.retry_max_delay_seconds, self.retry_base_delay_seconds*2**attempt))
+
+    async def request(self, session:aiohttp.ClientSession, method:str, url:str, authorize:Callable[[bool], Awaitable[dict]]|None=None, **kwargs):
+        '''send a request and return its decoded JSON body (None when the body is empty). authorize returns the authorization
+        headers and is called again with True to refresh the access token after a 401
+        '''
+        refreshed_token = False
+        base_headers = kwargs.pop('headers', {})
+        for attempt in range(self.max_retries + 1):
+            await self.__acquire()
+            headers = dict(base_headers)
+            if authorize is not None:
+                headers.update(await authorize(False))
+            if self.started_at is None:
+                self.started_at = time.monotonic()
+            self.requests += 1
+            delay = 0.0
+            try:
+                async with session.request(method, url, headers=headers, **kwargs) as response:
+                    self.finished_at = time.monotonic()
+                    if response.status == 429:
+                        self.throttled_responses += 1
+                        retry_after = float(response.headers.get('Retry-After', self.__backoff(attempt)))
+                        # every request waits, not only this one, the limit applies to the whole app
+                        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                        logger.warning(f'Rate limited by the Spotify API, pausing requests for {retry_after}s')
+                    elif response.status == 401 and authorize is not None and not refreshed_token:
+                        refreshed_token = True
+                        await authorize(True)
+                        logger.info('Spotify access token rejected, requested a new one')
+                    elif response.status >= 500:
+                        logger.warning(f'Spotify API returned {response.status} for {method} {url}')
+                        delay = self.__backoff(attempt)
+                    else:
+                        response.raise_for_status()
+                        return await response.json(content_type=None)
+                    if attempt == self.max_retries:
+                        response.raise_for_status()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f'Request to the Spotify API failed ({error!r}), retrying')
+                delay = self.__backoff(attempt)
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    def report(self)->dict:
+        elapsed = (self.finished_at or 0) - (self.started_at or 0)
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'throttled_responses': self.throttled_responses,
+            'throttled_seconds': self.throttled_seconds,
+            'requests_per_second': self.requests/elapsed if elapsed > 0 else None,
+        }
@@ -1,119 +1,266 @@
-from sqlalchemy import create_engine,text
+from sqlalchemy import create_engine
 from spotify_api_manager import SpotifyApiManager
 from ai_categorization import AIChatCategorization
-from playlist_optmizer import PlaylistOptimizer
+from playlist_optmizer import PlaylistOptimizer, PLAYLIST_COLUMNS
 from playlist_clusterer import PlaylistClusterer
+from instrumentation import StageProfiler
+from database_manager import DatabaseManager
+from datamodels import ConfigFile
+from job_runner import report_progress
 from dotenv import load_dotenv
 from loguru import logger
+from contextlib import nullcontext
 import pandas as pd
 import asyncio
+import json
 import os
 
 load_dotenv(override=True)
 
 class SongAnalytics:
     def __init__(self):
-        self.spotify_api_manager = SpotifyApiManager()
-        self.ai_categorization = AIChatCategorization()
         self.playlist_optimizer = PlaylistOptimizer()
-        self.playlist_clusterer = PlaylistClusterer()
-        self.current_playlist = pd.DataFrame()
         db_url = os.environ.get('db_url')
         self.engine = create_engine(db_url, echo=False)
+        self.database_manager = DatabaseManager(self.engine, **self.playlist_optimizer.config.database.model_dump())
+        self.spotify_api_manager = SpotifyApiManager(self.database_manager)
+        self.ai_categorization = AIChatCategorization(self.database_manager)
+        self.playlist_clusterer = PlaylistClusterer()
+        self.current_playlist = pd.DataFrame()
+        self.playlist_id = None
+        instrumentation = self.playlist_optimizer.config.general.instrumentation
+        self.profiler = StageProfiler(**instrumentation.model_dump())
+        self.playlist_optimizer.profiler = self.profiler
+        self.config_modified_at = os.stat(os.getenv('config_file_path')).st_mtime_ns
+
+    def reload_config(self)->None:
+        '''re-read the config file when it changed since it was last read. A SongAnalytics can outlive many edits of the file, like the
+        one kept by the app for a whole browser session, and the optimizer and the categorization only read it when built
+        '''
+        config_file_path = os.getenv('config_file_path')
+        modified_at = os.stat(config_file_path).st_mtime_ns
+        if modified_at == self.config_modified_at:
+            return
+        with open(config_file_path) as f:
+            config = ConfigFile(**json.load(f))
+        self.config_modified_at = modified_at
+        self.playlist_optimizer.apply_config(config)
+        self.ai_categorization.apply_config(config)
+        logger.info('Config file changed, settings reloaded')
 
-    async def load_playlist_from_spotify(self, playlist_id:str, country:str='BR')->pd.DataFrame:
+    async def load_playlist_from_spotify(self, playlist_id:str, country:str='BR', incremental:bool|None=None)->pd.DataFrame:
+        '''load the playlist from Spotify into the database. In incremental mode (the default from the config) nothing is done when
+        its snapshot_id has not changed since the last sync, and otherwise only the added tracks are fetched and inserted and only
+        the removed ones deleted, so the rows already stored keep their AI categories
+        '''
         self.playlist_id = playlist_id
-        await self.spotify_api_manager.get_token()
-        track_list = await self.spotify_api_manager.get_playlist_tracks(playlist_id, country)
+        self.profiler.reset()
+        self.spotify_api_manager.scheduler.reset_metrics()
+        if incremental is None:
+            incremental = self.spotify_api_manager.config.incremental_sync
+        stored_track_ids = self.database_manager.read_playlist_track_ids(playlist_id) if incremental else set()
+        incremental = incremental and len(stored_track_ids) > 0
 
-        genres_per_artist = await self.spotify_api_manager.create_artist_genre_dict(track_list)
-        track_list = self.spotify_api_manager.apply_genre_to_playlist(track_list, genres_per_artist)
+        with self.profiler.stage('spotify_fetch'):
+            await self.spotify_api_manager.get_token()
+            snapshot_id = await self.spotify_api_manager.get_playlist_snapshot_id(playlist_id)
+            if incremental and snapshot_id == self.database_manager.read_snapshot_id(playlist_id):
+                logger.info(f'Playlist {playlist_id} has not changed since the last sync')
+                self.current_playlist = self.database_manager.read_playlist(playlist_id)
+                self.database_manager.replace_table('current_playlist', self.current_playlist)
+                self.profiler.write_trace()
+                return self.current_playlist
 
-        # get the audio features of the tracks
-        track_list = await self.spotify_api_manager.get_audio_features(track_list)
+            # a single transaction, so a failed load leaves the stored playlist as it was
+            cache = self.spotify_api_manager.cache
+            async with cache.deferred_writes() if cache is not None else nullcontext():
+                with self.engine.begin() as connection:
+                    if not incremental:
+                        self.database_manager.delete_playlist_rows(connection, playlist_id)
+                    playlist_track_ids = await self.stream_playlist_to_db(connection, playlist_id, country, stored_track_ids)
+                    removed_track_ids = stored_track_ids.difference(playlist_track_ids)
+                    self.database_manager.delete_playlist_rows(connection, playlist_id, removed_track_ids)
+                    self.database_manager.store_snapshot_id(connection, playlist_id, snapshot_id)
+            if incremental:
+                logger.info(f'Playlist {playlist_id} changed: {len(removed_track_ids)} tracks removed')
 
-        self.current_playlist = pd.DataFrame(track_list)
-        self.current_playlist.drop(columns=['artist_data','key_code','mode_code'], inplace=True)
-        self.current_playlist['playlist_id'] = playlist_id
-        with self.engine.connect() as connection:
-            connection.execute(text(f"DELETE FROM playlist WHERE playlist_id = '{playlist_id}'"))
-            connection.commit()
+        request_metrics = self.spotify_api_manager.scheduler.report()
+        logger.info(f'Spotify requests: {request_metrics}')
+        self.profiler.count('spotify_requests', request_metrics['requests'])
+        self.profiler.count('spotify_retries', request_metrics['retries'])
+        self.profiler.count('spotify_throttled_responses', request_metrics['throttled_responses'])
 
-        self.current_playlist.to_sql('playlist', con=self.engine, if_exists='append', index=False)
-        self.current_playlist.to_sql('current_playlist', con=self.engine, if_exists='replace', index=False)
+        with self.profiler.stage('db_read'):
+            self.current_playlist = self.database_manager.read_playlist(playlist_id)
+        # pages are written as they arrive, restore the order of the tracks in the Spotify playlist
+        position = {track_id: i for i, track_id in enumerate(playlist_track_ids)}
+        self.current_playlist = self.current_playlist.sort_values('id', key=lambda ids: ids.map(position), kind='stable', ignore_index=True)
+        self.database_manager.replace_table('current_playlist', self.current_playlist)
+        self.profiler.write_trace()
         return self.current_playlist
-    
+
+    async def stream_playlist_to_db(self, connection, playlist_id:str, country:str, skip_track_ids:set)->list[str]:
+        '''streaming pipeline from Spotify to the playlist table. Each page of tracks goes to the enrichment workers (genres and audio
+        features) as soon as it arrives, and the enriched rows are appended to the table in batches of db_flush_rows, so the
+        three stages overlap. The queues are bounded, which keeps only a few pages in memory at a time.
+        Tracks in skip_track_ids are already stored and are not fetched again. Returns the track ids of the playlist, in order
+        '''
+        settings = self.spotify_api_manager.config
+        pages = asyncio.Queue(maxsize=settings.pipeline_queue_size)
+        rows = asyncio.Queue(maxsize=settings.pipeline_queue_size)
+        track_ids_per_page = {}
+        tracks_written = 0
+        flush = None
+
+        async def fetch_pages()->None:
+            async for offset, track_list in self.spotify_api_manager.iter_playlist_tracks(playlist_id, country):
+                track_ids_per_page[offset] = [track['id'] for track in track_list]
+                self.profiler.count('tracks_fetched', len(track_list))
+                report_progress('pages_fetched', len(track_ids_per_page))
+                track_list = [track for track in track_list if track['id'] not in skip_track_ids]
+                if track_list:
+                    await pages.put(track_list)
+            for _ in range(settings.pipeline_workers):
+                await pages.put(None)
+
+        async def enrich_pages()->None:
+            while (track_list := await pages.get()) is not None:
+                await rows.put(await self.fetch_track_details(track_list))
+            await rows.put(None)
+
+        async def write_rows()->None:
+            nonlocal tracks_written, flush
+            finished_workers = 0
+            buffer = []
+            while finished_workers < settings.pipeline_workers:
+                page_rows = await rows.get()
+                if page_rows is None:
+                    finished_workers += 1
+                elif not page_rows.empty:
+                    buffer.append(page_rows)
+                if buffer and (finished_workers == settings.pipeline_workers or sum(map(len, buffer)) >= settings.db_flush_rows):
+                    new_tracks = pd.concat(buffer, ignore_index=True)
+                    new_tracks['playlist_id'] = playlist_id
+                    buffer = []
+                    with self.profiler.stage('db_write'):
+                        # off the event loop, so the fetches keep going while the rows are written. A thread cannot be cancelled,
+                        # so the write is shielded and a failed load waits for it before the transaction rolls back
+                        flush = asyncio.ensure_future(asyncio.to_thread(self.database_manager.append_rows, connection, 'playlist', new_tracks))
+                        await asyncio.shield(flush)
+                    self.profiler.count('tracks_written', len(new_tracks))
+                    tracks_written += len(new_tracks)
+                    report_progress('tracks_written', tracks_written)
+
+        stages = [asyncio.ensure_future(stage) for stage in [fetch_pages(), write_rows()] + [enrich_pages() for _ in range(settings.pipeline_workers)]]
+        try:
+            await asyncio.gather(*stages)
+        except BaseException:
+            for stage in stages:
+                stage.cancel()
+            if flush is not None:
+                await asyncio.wait([flush])
+            raise
+        return [track_id for offset in sorted(track_ids_per_page) for track_id in track_ids_per_page[offset]]
+
+    async def fetch_track_details(self, track_list:list[dict])->pd.DataFrame:
+        '''genres and audio features of the tracks, requested concurrently, as they are stored in the playlist table
+        '''
+        async def stage(name:str, coroutine):
+            with self.profiler.stage(name):
+                return await coroutine
+        genres_per_artist, track_list = await asyncio.gather(
+            stage('genre_lookup', self.spotify_api_manager.create_artist_genre_dict(track_list)),
+            stage('audio_features', self.spotify_api_manager.get_audio_features(track_list))
+        )
+        track_list = self.spotify_api_manager.apply_genre_to_playlist(track_list, genres_per_artist)
+        self.profiler.count('artists_fetched', len(genres_per_artist))
+        tracks = pd.DataFrame(track_list)
+        return tracks.drop(columns=['artist_data','key_code','mode_code'], errors='ignore')
+
     def get_current_playlist(self)->pd.DataFrame:
         return self.current_playlist
 
     def categorize_playlist_with_ai(self,playlist_id:str)->None:
         logger.info(f'Categorizing the playlist {playlist_id} with AI')
-        playlist_table = pd.read_sql("playlist", con=self.engine)
-        playlist_db_with_no_duplicates = playlist_table.drop_duplicates(subset=['id'])
-        playlist_db_with_no_duplicates = playlist_db_with_no_duplicates.dropna(subset=['genre'])
-        playlist_table = playlist_table.merge(playlist_db_with_no_duplicates[['id','genre','decade','country']], on='id', how='left', suffixes=('', '_db'))
-        for column in ['genre','decade','country']:
-            playlist_table[column] = playlist_table[column].fillna(playlist_table[column+'_db'])
-            playlist_table = playlist_table.drop(columns=[column+'_db'])
-        mask = playlist_table['playlist_id'] == playlist_id
-        self.current_playlist = playlist_table[mask]
+        self.reload_config()
+        self.profiler.reset()
+        with self.profiler.stage('db_read'):
+            self.current_playlist = self.database_manager.read_playlist(playlist_id)
+        # categories of tracks seen in other playlists come from the category cache and the rows of those playlists
         if self.current_playlist.empty:
             raise ValueError(f'Playlist with id {playlist_id} not found in db')
-        elif self.current_playlist['genre'].notnull().all():
+        elif 'genre' in self.current_playlist.columns and self.current_playlist['genre'].notnull().all():
             logger.info('Playlist already categorized')
         else:
-            self.current_playlist = self.ai_categorization.get_categorization(self.current_playlist, ['id','name', 'artists', 'genres','album','release_date'])
+            with self.profiler.stage('categorization'):
+                self.current_playlist = self.ai_categorization.get_categorization(self.current_playlist, ['id','name', 'artists', 'genres','album','release_date'])
             logger.info('Saving the categorized playlist')
-        with self.engine.connect() as connection:
-            connection.execute(text(f"DELETE FROM playlist WHERE playlist_id = '{playlist_id}'"))
-            connection.commit()
-        self.current_playlist.to_sql('playlist', con=self.engine, if_exists='append', index=False)
-        self.current_playlist.to_sql('current_playlist', con=self.engine, if_exists='replace', index=False)
+        with self.profiler.stage('db_write'):
+            self.database_manager.replace_playlist_rows(playlist_id, self.current_playlist)
+            self.database_manager.replace_table('current_playlist', self.current_playlist)
+        self.profiler.write_trace()
 
-    def build_setlist_from_playlist(self,result_playlist_name:str, result_playlist_description:str)->dict:
+    def build_setlist_from_playlist(self, playlist_id:str|None, result_playlist_name:str, result_playlist_description:str, solver:str|None=None)->dict:
+        '''optimize a setlist out of the rows of playlist_id, or out of every stored playlist when it is None
+        '''
         result_dict = {}
+        self.reload_config()
         logger.info('Starting the playlist optimization process')
+        self.profiler.reset()
+        with self.profiler.profile_run('build_setlist_from_playlist'):
+            logger.info('Loading the playlist data')
+            with self.profiler.stage('db_read'):
+                playlist = self.database_manager.read_playlist(playlist_id, columns=PLAYLIST_COLUMNS)
 
-        logger.info('Loading the playlist data')
-        playlist = pd.read_sql('playlist', con=self.engine)
+            logger.info(f'Running the {solver or self.playlist_optimizer.default_optimization_parameters.solver} solver')
 
-        logger.info('Running the genetic algorithm')
-
-        playlist_optimizer = self.playlist_optimizer
-        playlist_clusterer = self.playlist_clusterer
-        
-        playlist_optimizer.load_playlist(playlist)
+            playlist_optimizer = self.playlist_optimizer
+            playlist_clusterer = self.playlist_clusterer
+            
+            with self.profiler.stage('playlist_encoding'):
+                playlist_optimizer.load_playlist(playlist)
 
+            with self.profiler.stage('optimization'):
+                result = playlist_optimizer.run_solver(solver)
 
-        result = playlist_optimizer.run_ga()
+                result = playlist_optimizer.remove_duplicates(result)
 
-        result = playlist_optimizer.remove_duplicates(result)
+            # the full rows of the chosen tracks only, in setlist order
+            setlist_ids = playlist['id'].iloc[result].tolist()
+            with self.profiler.stage('db_read'):
+                result_df = self.database_manager.read_tracks(setlist_ids, playlist_id).drop_duplicates(subset=['id'])
+            result_df:pd.DataFrame = result_df.set_index('id').loc[setlist_ids].reset_index()
 
-        result_df:pd.DataFrame = playlist.loc[result]
+            logger.info("adding cluster column")
+            with self.profiler.stage('clustering'):
+                result_df = playlist_clusterer.cluster_pipeline(result_df)
 
-        logger.info("adding cluster column")
-        result_df = playlist_clusterer.cluster_pipeline(result_df)
+            logger.info('Saving the optimized playlist')
+            with self.profiler.stage('db_write'):
+                self.database_manager.replace_table('current_playlist', result_df)
+            logger.info('Optimized playlist:')
+            print(result_df[['name', 'artists']])
+            result_dict['playlist'] = result_df
 
-        logger.info('Saving the optimized playlist')
-        result_df.to_sql('current_playlist', con=self.engine, if_exists='replace', index=False)
-        logger.info('Optimized playlist:')
-        print(result_df[['name', 'artists']])
-        result_dict['playlist'] = result_df
+            setlist_features = playlist_optimizer.calculate_setlist_features(result_df)
+            logger.info('Setlist features:')
+            print(setlist_features)
+            result_dict['setlist_features'] = setlist_features
 
-        setlist_features = playlist_optimizer.calculate_setlist_features(result_df)
-        logger.info('Setlist features:')
-        print(setlist_features)
-        result_dict['setlist_features'] = setlist_features
+            score = playlist_optimizer.fitness_function(result)
+            logger.info('Setlist score:')
+            print(score)
+            result_dict['score'] = score
 
-        score = playlist_optimizer.fitness_function(result)
-        logger.info('Setlist score:')
-        print(score)
-        result_dict['score'] = score
+        if self.profiler.enabled:
+            result_dict['instrumentation'] = self.profiler.report()
+            self.profiler.write_trace()
         return result_dict
 
     def evaluate_setlist(self)->tuple[dict, float]:
+        self.reload_config()
         if self.current_playlist.empty:
-            self.current_playlist = pd.read_sql('current_playlist', con=self.engine)
+            self.current_playlist = self.database_manager.read_table('current_playlist')
         playlist_optimizer = self.playlist_optimizer
         playlist_optimizer.load_playlist(self.current_playlist)
         setlist_features = playlist_optimizer.calculate_setlist_features(self.current_playlist)
@@ -123,31 +270,34 @@ class SongAnalytics:
 
 
     def categorize_and_run_song_analytcs(self, playlist_id:str, country:str='BR')->None:
-        asyncio.run(self.load_playlist_from_spotify(playlist_id, country))
-        self.categorize_playlist_with_ai()
-        self.build_setlist_from_playlist()
+        async def load_playlist()->None:
+            async with self.spotify_api_manager:
+                await self.load_playlist_from_spotify(playlist_id, country)
+        asyncio.run(load_playlist())
+        self.categorize_playlist_with_ai(playlist_id)
+        self.build_setlist_from_playlist(playlist_id, 'Setlist', 'Setlist gerado automaticamente')
 
     async def create_setlist_playlist(self, playlist_name:str, playlist_description:str)->None:
-        current_playlist = pd.read_sql('current_playlist', con=self.engine)
+        current_playlist = self.database_manager.read_table('current_playlist', columns=['id'])
         playlist_tracks = current_playlist['id'].tolist()
         await self.spotify_api_manager.get_token()
         playlist_id = await self.spotify_api_manager.create_setlist_playlist(playlist_name, playlist_description, playlist_tracks)
         return playlist_id
 
     async def update_setlist_playlist(self, playlist_id:str)->None:
-        current_playlist = pd.read_sql('current_playlist', con=self.engine)
+        current_playlist = self.database_manager.read_table('current_playlist', columns=['id'])
         playlist_tracks = current_playlist['id'].tolist()
         await self.spotify_api_manager.get_token()
         await self.spotify_api_manager.update_setlist_playlist(playlist_id, playlist_tracks)
 
     async def load_playlist_from_db(self, playlist_id:str)->pd.DataFrame:
-        self.current_playlist = pd.read_sql(f"SELECT * FROM playlist WHERE playlist_id = '{playlist_id}'", con=self.engine)
+        self.current_playlist = self.database_manager.read_playlist(playlist_id)
         if self.current_playlist.empty:
             await self.load_playlist_from_spotify(playlist_id)
             return self.current_playlist
-        self.current_playlist.to_sql('current_playlist', con=self.engine, if_exists='replace', index=False)
+        self.database_manager.replace_table('current_playlist', self.current_playlist)
         return self.current_playlist
     
     def load_current_setlist_from_db(self)->pd.DataFrame:
-        self.current_playlist = pd.read_sql('current_playlist', con=self.engine)
+        self.current_playlist = self.database_manager.read_table('current_playlist')
         return self.current_playlist
\ No newline at end of file
@@ -1,11 +1,30 @@
+from request_scheduler import RequestScheduler
+from spotify_cache import SpotifyCache
+from database_manager import DatabaseManager
+from sqlalchemy import create_engine
+from datamodels import ConfigFile
 import os
+import json
+import time
+import asyncio
 import itertools
 import aiohttp
 from loguru import logger
 
 
 class SpotifyApiManager():
-    def __init__(self):
+    def __init__(self, database_manager:DatabaseManager|None=None):
+        '''the response cache is kept in the database of database_manager, or of db_url when none is given
+        '''
+        with open(os.getenv('config_file_path')) as f:
+            self.config = ConfigFile(**json.load(f)).spotify
+        self.scheduler = RequestScheduler(**self.config.rate_limit.model_dump())
+        self.cache = None
+        if database_manager is None and os.getenv('db_url'):
+            database_manager = DatabaseManager(create_engine(os.getenv('db_url')))
+        if self.config.cache_enabled and database_manager is not None:
+            ttl_seconds = None if self.config.cache_ttl_hours is None else self.config.cache_ttl_hours*3600
+            self.cache = SpotifyCache(database_manager, ttl_seconds)
         self.client_id = os.environ.get('client_id')
         self.client_secret = os.environ.get('client_secret')
         self.api_base_url = os.environ.get('api_base_url')
@@ -30,130 +49,242 @@ class SpotifyApiManager():
             1: 'Major'
         }
         self.token = None
+        self.token_expires_at = 0.0
+        self.token_request = None
+        self.session = None
+        self.session_loop = None
 
-    async def get_token(self)->None:
-        if self.token is None:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.api_auth_url,
-                    data={
-                        'grant_type': 'client_credentials',
-                        'client_id': self.client_id,
-                        'client_secret': self.client_secret
-                    }
-                ) as response:
-                    response_json = await response.json()
-                    self.token = response_json['access_token']
-                        
-    async def get_playlist_tracks(self, playlist_id:str, country:str='BR')->list:
-        track_list = []
+    async def __aenter__(self):
+        await self.get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback)->None:
+        await self.close()
+
+    async def get_session(self)->aiohttp.ClientSession:
+        '''the long-lived session shared by every request, created on first use. A session belongs to the event loop that created it,
+        so a new one is opened when the manager is used from another loop (as each asyncio.run creates its own)
+        '''
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.session_loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.config.connection_limit,
+                limit_per_host=self.config.connection_limit_per_host,
+                ttl_dns_cache=self.config.dns_cache_ttl_seconds,
+                keepalive_timeout=self.config.keepalive_timeout_seconds
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.config.request_timeout_seconds)
+            )
+            self.session_loop = loop
+            logger.debug('Opened a new Spotify API session')
+        return self.session
+
+    async def close(self)->None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.session_loop = None
+
+    async def get_token(self, refresh:bool=False)->None:
+        '''request a new access token when there is none, when it expires in less than token_refresh_margin_seconds or when
+        refresh is set. Concurrent callers wait for the same token request
+        '''
+        expiring = time.monotonic() >= self.token_expires_at - self.config.token_refresh_margin_seconds
+        if self.token is None or expiring or refresh:
+            if self.token_request is None or self.token_request.done():
+                self.token_request = asyncio.ensure_future(self.__request_token())
+            await self.token_request
+
+    async def __request_token(self)->None:
+        session = await self.get_session()
+        response_json = await self.scheduler.request(
+            session,
+            'POST',
+            self.api_auth_url,
+            data={
+                'grant_type': 'client_credentials',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret
+            }
+        )
+        self.token = response_json['access_token']
+        self.token_expires_at = time.monotonic() + response_json.get('expires_in', 3600)
+
+    async def __authorization_headers(self, refresh:bool=False)->dict:
+        await self.get_token(refresh)
+        return {'Authorization': f'Bearer {self.token}'}
+
+    async def request(self, method:str, url:str, **kwargs):
+        '''send an authorized request through the scheduler and return its decoded JSON body
+        '''
+        session = await self.get_session()
+        return await self.scheduler.request(session, method, url, self.__authorization_headers, **kwargs)
+
+    async def get_playlist_snapshot_id(self, playlist_id:str)->str:
+        '''the version of the playlist, which changes whenever its tracks do
+        '''
+        response_json = await self.request('GET', f'{self.api_base_url}/playlists/{playlist_id}', params={'fields': 'snapshot_id'})
+        return response_json['snapshot_id']
+
+    @staticmethod
+    def parse_track(track:dict)->dict:
+        return {
+            'id': track['id'],
+            'name': track['name'],
+            'artist_data': track['artists'],
+            'artists': ','.join([artist['name'] for artist in track['artists']]),
+            'album': track['album']['name'],
+            'popularity': track['popularity'],
+            'preview_url': track['preview_url'],
+            'release_date': track['album']['release_date'],
+            'release_date_precision': track['album']['release_date_precision'],
+            'duration_ms': track['duration_ms']
+        }
+
+    async def get_playlist_tracks_page(self, semaphore:asyncio.Semaphore, playlist_id:str, country:str, offset:int)->tuple[int, list[dict]]:
+        params = {'country': country, 'offset': offset, 'limit': self.config.playlist_page_size}
+        if self.config.playlist_track_fields is not None:
+            params['fields'] = self.config.playlist_track_fields
+        async with semaphore:
+            page = await self.request('GET', f'{self.api_base_url}/playlists/{playlist_id}/tracks', params=params)
+        # removed tracks come back as items without a track
+        track_list = [self.parse_track(item['track']) for item in page.get('items', []) if item.get('track') is not None]
+        return page.get('total', 0), track_list
+
+    async def iter_playlist_tracks(self, playlist_id:str, country:str='BR'):
+        '''yield the offset and the tracks of each page of the playlist as soon as it arrives. The first page gives the total number
+        of tracks, so the offsets of all the other pages are known up front and they are fetched concurrently, in completion order.
+        At most playlist_prefetch_pages pages are requested ahead of the consumer, so a slow consumer bounds the pages held in memory
+        '''
         await self.get_token()
-        finished_getting_tracks = False
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f'{self.api_base_url}/playlists/{playlist_id}/tracks?country={country}',
-                headers={
-                    'Authorization': f'Bearer {self.token}'
-                }
-            ) as response:
-                response_json = await response.json()
-                
-                if 'items' in response_json:
-                    for item in response_json['items']:
-                        track = item['track']
-                        track_list.append(
-                            {
-                            'id': track['id'],
-                            'name': track['name'],
-                            'artist_data': track['artists'],
-                            'artists': ','.join([artist['name'] for artist in track['artists']]),
-                            'album': track['album']['name'],
-                            'popularity': track['popularity'],
-                            'preview_url': track['preview_url'],
-                            'release_date': track['album']['release_date'],
-                            'release_date_precision': track['album']['release_date_precision'],
-                            'duration_ms': track['duration_ms']
-                        }
-                        )
-                    
-                if response_json['next'] is None:
-                    finished_getting_tracks = True
-                while not finished_getting_tracks:
-                    async with session.get(
-                        response_json['next'],
-                        headers={
-                            'Authorization': f'Bearer {self.token}'
-                        }
-                    ) as response:
-                        response_json = await response.json()
-                        if 'items' in response_json:
-                            for item in response_json['items']:
-                                track = item['track']
-                                track_list.append(
-                                    {   
-                                        'id': track['id'],
-                                        'name': track['name'],
-                                        'artist_data': track['artists'],
-                                        'artists': ','.join([artist['name'] for artist in track['artists']]),
-                                        'album': track['album']['name'],
-                                        'popularity': track['popularity'],
-                                        'preview_url': track['preview_url'],
-                                        'release_date': track['album']['release_date'],
-                                        'release_date_precision': track['album']['release_date_precision'],
-                                        'duration_ms': track['duration_ms']
-                                    }
-                                )
-                        if response_json['next'] is None:
-                            finished_getting_tracks = True
+        semaphore = asyncio.Semaphore(self.config.max_concurrent_requests)
+        total, track_list = await self.get_playlist_tracks_page(semaphore, playlist_id, country, 0)
+        yield 0, track_list
+
+        async def get_page(offset:int)->tuple[int, list[dict]]:
+            _, track_list = await self.get_playlist_tracks_page(semaphore, playlist_id, country, offset)
+            return offset, track_list
+
+        page_size = self.config.playlist_page_size
+        offsets = iter(range(page_size, total, page_size))
+        pages = set()
+        try:
+            while True:
+                # a new page is requested only once the consumer took one, between the yields
+                while len(pages) < self.config.playlist_prefetch_pages and (offset := next(offsets, None)) is not None:
+                    pages.add(asyncio.ensure_future(get_page(offset)))
+                if not pages:
+                    break
+                done, pages = await asyncio.wait(pages, return_when=asyncio.FIRST_COMPLETED)
+                for page in done:
+                    yield page.result()
+        finally:
+            # the consumer stopped early or failed
+            for page in pages:
+                page.cancel()
+
+    async def get_playlist_tracks(self, playlist_id:str, country:str='BR')->list:
+        pages = {offset: track_list async for offset, track_list in self.iter_playlist_tracks(playlist_id, country)}
+        track_list = [track for offset in sorted(pages) for track in pages[offset]]
+        logger.info(f'Fetched {len(track_list)} tracks of the playlist {playlist_id} in {len(pages)} pages')
         return track_list
 
     async def get_artist_genres(self, artist_id:str)->list:
+        if self.cache is not None:
+            cached = await self.cache.get('artist_genres', [artist_id])
+            if artist_id in cached:
+                return cached[artist_id]
         genre_list = []
         await self.get_token()
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f'{self.api_base_url}/artists/{artist_id}',
-                headers={
-                    'Authorization': f'Bearer {self.token}'
-                }
-            ) as response:
-                response_json = await response.json()
-                if 'genres' in response_json:
-                    genre_list = response_json['genres']
+        response_json = await self.request('GET', f'{self.api_base_url}/artists/{artist_id}')
+        if 'genres' in response_json:
+            genre_list = response_json['genres']
+        if self.cache is not None:
+            await self.cache.put('artist_genres', {artist_id: genre_list})
         return genre_list
-    
+
+    async def get_artists_genres(self, semaphore:asyncio.Semaphore, artist_ids:list[str])->dict:
+        '''genres of a batch of artists, fetched with a single request to the several artists endpoint
+        '''
+        async with semaphore:
+            response_json = await self.request(
+                'GET',
+                f'{self.api_base_url}/artists',
+                params={'ids': ','.join(artist_ids)}
+            )
+        # ids that Spotify does not know come back as null entries
+        return {artist['id']: artist.get('genres', []) for artist in response_json.get('artists', []) if artist is not None}
 
     async def create_artist_genre_dict(self, playlist:list[str])->dict:
         artists_data = [playlist[track]['artist_data'] for track in range(len(playlist))]
         artists_data_flat = list(itertools.chain.from_iterable(artists_data))
-        artists_id = set([artist['id'] for artist in artists_data_flat])
-        genres_per_artist = [await self.get_artist_genres(artist_id) for artist_id in artists_id]
-        return dict(zip(artists_id, genres_per_artist))
+        artists_id = list(dict.fromkeys([artist['id'] for artist in artists_data_flat]))
+        cached = {} if self.cache is None else await self.cache.get('artist_genres', artists_id)
+        missing_ids = [artist_id for artist_id in artists_id if artist_id not in cached]
+        batch_size = self.config.artists_batch_size
+        batches = [missing_ids[i:i + batch_size] for i in range(0, len(missing_ids), batch_size)]
+        await self.get_token()
+        # the semaphore is created here and not in __init__ because every asyncio.run has its own event loop
+        semaphore = asyncio.Semaphore(self.config.max_concurrent_requests)
+        genres_per_batch = await asyncio.gather(*[self.get_artists_genres(semaphore, batch) for batch in batches])
+        fetched = {artist_id: [] for artist_id in missing_ids}
+        for batch_genres in genres_per_batch:
+            fetched.update(batch_genres)
+        if self.cache is not None:
+            await self.cache.put('artist_genres', fetched)
+        artist_genre_dict = {artist_id: cached[artist_id] if artist_id in cached else fetched[artist_id] for artist_id in artists_id}
+        logger.info(f'Fetched the genres of {len(missing_ids)} artists in {len(batches)} requests')
+        return artist_genre_dict
     
+    async def get_audio_features_batch(self, semaphore:asyncio.Semaphore, track_ids:list[str])->dict:
+        '''audio features of a batch of tracks, fetched with a single request to the several tracks endpoint
+        '''
+        async with semaphore:
+            response_json = await self.request(
+                'GET',
+                f'{self.api_base_url}/audio-features',
+                params={'ids': ','.join(track_ids)}
+            )
+        # tracks without analysis come back as null entries
+        return {feature['id']: feature for feature in response_json.get('audio_features', []) if feature is not None}
+
+    def __apply_audio_features(self, track:dict, feature:dict)->None:
+        track['danceability'] = feature.get('danceability')
+        track['energy'] = feature.get('energy')
+        track['key_code'] = feature.get('key')
+        track['key'] = self.pitch_class_notation_dict.get(feature.get('key'))
+        track['loudness'] = feature.get('loudness')
+        track['mode_code'] = feature.get('mode')
+        track['mode'] = self.mode_dict.get(feature.get('mode'))
+        track['speechiness'] = feature.get('speechiness')
+        track['acousticness'] = feature.get('acousticness')
+        track['instrumentalness'] = feature.get('instrumentalness')
+        track['liveness'] = feature.get('liveness')
+        track['valence'] = feature.get('valence')
+        track['tempo'] = feature.get('tempo')
+        track['time_signature'] = feature.get('time_signature')
+
     async def get_audio_features(self, playlist:list[dict])->list[dict]:
+        track_ids = list(dict.fromkeys([track['id'] for track in playlist if track['id'] is not None]))
+        features = {} if self.cache is None else await self.cache.get('audio_features', track_ids)
+        missing_ids = [track_id for track_id in track_ids if track_id not in features]
+        batch_size = self.config.audio_features_batch_size
+        batches = [missing_ids[i:i + batch_size] for i in range(0, len(missing_ids), batch_size)]
         await self.get_token()
-        async with aiohttp.ClientSession() as session:
-            for track in playlist:
-                async with session.get(
-                f'{self.api_base_url}/audio-features/{track["id"]}',
-                headers={
-                    'Authorization': f'Bearer {self.token}'
-                }
-            ) as response:
-                    feature = await response.json()
-
-                track['danceability'] = feature.get('danceability')
-                track['energy'] = feature.get('energy')
-                track['key_code'] = feature.get('key')
-                track['key'] = self.pitch_class_notation_dict.get(feature.get('key'))
-                track['loudness'] = feature.get('loudness')
-                track['mode_code'] = feature.get('mode')
-                track['mode'] = self.mode_dict.get(feature.get('mode'))
-                track['speechiness'] = feature.get('speechiness')
-                track['acousticness'] = feature.get('acousticness')
-                track['valence'] = feature.get('valence')
-                track['tempo'] = feature.get('tempo')
-                track['time_signature'] = feature.get('time_signature')
+        semaphore = asyncio.Semaphore(self.config.max_concurrent_requests)
+        features_per_batch = await asyncio.gather(*[self.get_audio_features_batch(semaphore, batch) for batch in batches])
+        # tracks the API had no features for are kept as None, so they are cached too
+        fetched = {track_id: None for track_id in missing_ids}
+        for batch_features in features_per_batch:
+            fetched.update(batch_features)
+        if self.cache is not None:
+            await self.cache.put('audio_features', fetched)
+        features.update(fetched)
+        for track in playlist:
+            self.__apply_audio_features(track, features.get(track['id']) or {})
+        logger.info(f'Fetched the audio features of {len(missing_ids)} tracks in {len(batches)} requests, {sum(feature is None for feature in fetched.values())} without features')
         return playlist
 
     @staticmethod
@@ -169,45 +300,42 @@ class SpotifyApiManager():
     
     async def create_setlist_playlist(self, playlist_name:str, playlist_description:str, playlist_tracks:list[str])->str:
         await self.get_token()
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f'{self.api_base_url}/users/{os.environ.get("user_id")}/playlists',
-                headers={
-                    'Authorization': f'Bearer {self.token}',
-                    'Content-Type': 'application/json'
-                },
-                json={
-                    'name': playlist_name,
-                    'description': playlist_description,
-                    'public': False
-                }
-            ) as response:
-                response_json = await response.json()
-                playlist_id = response_json['id']
-                playlist_tracks = [{'uri': f'spotify:track:{track}'} for track in playlist_tracks]
-                await session.post(
-                    f'{self.api_base_url}/playlists/{playlist_id}/tracks',
-                    headers={
-                        'Authorization': f'Bearer {self.token}',
-                        'Content-Type': 'application/json'
-                    },
-                    json={
-                        'uris': playlist_tracks
-                    }
-                )
+        response_json = await self.request(
+            'POST',
+            f'{self.api_base_url}/users/{os.environ.get("user_id")}/playlists',
+            headers={
+                'Content-Type': 'application/json'
+            },
+            json={
+                'name': playlist_name,
+                'description': playlist_description,
+                'public': False
+            }
+        )
+        playlist_id = response_json['id']
+        playlist_tracks = [{'uri': f'spotify:track:{track}'} for track in playlist_tracks]
+        await self.request(
+            'POST',
+            f'{self.api_base_url}/playlists/{playlist_id}/tracks',
+            headers={
+                'Content-Type': 'application/json'
+            },
+            json={
+                'uris': playlist_tracks
+            }
+        )
         return playlist_id
     
     async def update_setlist_playlist(self, playlist_id:str, playlist_tracks:list[str])->None:
         await self.get_token()
-        async with aiohttp.ClientSession() as session:
-            playlist_tracks = [{'uri': f'spotify:track:{track}'} for track in playlist_tracks]
-            await session.put(
-                f'{self.api_base_url}/playlists/{playlist_id}/tracks',
-                headers={
-                    'Authorization': f'Bearer {self.token}',
-                    'Content-Type': 'application/json'
-                },
-                json={
-                    'uris': playlist_tracks
-                }
-            )
\ No newline at end of file
+        playlist_tracks = [{'uri': f'spotify:track:{track}'} for track in playlist_tracks]
+        await self.request(
+            'PUT',
+            f'{self.api_base_url}/playlists/{playlist_id}/tracks',
+            headers={
+                'Content-Type': 'application/json'
+            },
+            json={
+                'uris': playlist_tracks
+            }
+        )
\ No newline at end of file
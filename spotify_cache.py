@@ -0,0 +1,66 @@
+from database_manager import DatabaseManager
+from sqlalchemy import column
+from contextlib import asynccontextmanager
+from loguru import logger
+import asyncio
+import json
+import time
+
+# cache tables, created by DatabaseManager.create_schema
+CACHE_TABLES = {
+    'artist_genres': 'spotify_artist_genres_cache',
+    'audio_features': 'spotify_audio_features_cache',
+}
+
+class SpotifyCache():
+    '''persistent cache of the Spotify responses that almost never change, stored in the app database next to the playlists.
+    Each cache table maps a Spotify id to its JSON response, which may be null for ids the API had nothing for, so those are not
+    requested again either. Entries older than ttl_seconds are treated as missing, a ttl of None keeps them forever.
+    The queries run in a worker thread, so they do not stall the event loop the Spotify requests run on
+    '''
+    def __init__(self, database_manager:DatabaseManager, ttl_seconds:float|None=None) -> None:
+        self.database_manager = database_manager
+        self.ttl_seconds = ttl_seconds
+        self.hits = {name: 0 for name in CACHE_TABLES}
+        self.misses = {name: 0 for name in CACHE_TABLES}
+        self.pending = None
+
+    def __read(self, name:str, ids:list[str])->dict:
+        oldest = 0.0 if self.ttl_seconds is None else time.time() - self.ttl_seconds
+        rows = self.database_manager.read_in(CACHE_TABLES[name], 'id', ids, ['id', 'data'], [column('fetched_at') >= oldest])
+        return {id: json.loads(data) for id, data in zip(rows['id'], rows['data'])}
+
+    def __write(self, name:str, values:dict)->None:
+        fetched_at = time.time()
+        self.database_manager.upsert(CACHE_TABLES[name], 'id', [{'id': id, 'data': json.dumps(value), 'fetched_at': fetched_at} for id, value in values.items()])
+
+    async def get(self, name:str, ids:list[str])->dict:
+        cached = {} if self.pending is None else {id: self.pending[name][id] for id in ids if id in self.pending[name]}
+        missing = [id for id in ids if id not in cached]
+        if missing:
+            cached.update(await asyncio.to_thread(self.__read, name, missing))
+        self.hits[name] += len(cached)
+        self.misses[name] += len(ids) - len(cached)
+        logger.info(f'Spotify {name} cache: {len(cached)} hits, {len(ids) - len(cached)} misses')
+        return cached
+
+    async def put(self, name:str, values:dict)->None:
+        if not values:
+            return
+        if self.pending is not None:
+            self.pending[name].update(values)
+            return
+        await asyncio.to_thread(self.__write, name, values)
+
+    @asynccontextmanager
+    async def deferred_writes(self):
+        '''keep the puts in memory and write them on exit. SQLite has a single writer, so the cache cannot be written from another
+        connection of the pool while one holds an open write transaction on the same database, like the one of a playlist load
+        '''
+        self.pending = {name: {} for name in CACHE_TABLES}
+        try:
+            yield
+        finally:
+            pending, self.pending = self.pending, None
+            for name, values in pending.items():
+                await self.put(name, values)